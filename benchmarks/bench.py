@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+#encoding=utf-8
+"""Benchmarks of the database, the list view, navigation, playing,
+cue sheet export and import at several database sizes.
+
+    ./benchmarks/bench.py -o before.json
+    ... change something ...
+    ./benchmarks/bench.py -o after.json --compare before.json
+
+Synthetic databases of --sizes rows are generated once into --data-dir
+and reused, the 1M row one takes about a minute. Playing is timed with
+benchmarks/fake_mocp as the mocp binary, at every --latency, and
+over the socket against tools/fake_moc_server.py. The import runs
+the import command on a JSONL file of the synthetic bookmarks, in a
+process of its own to measure its peak RSS. Results are written as
+JSON, with the commit they were measured at.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+from mocp_bookmarks import (BookmarkDatabase, MocController, MocSocketController,
+        PlayerStatus, PlayingController, CueExporter, bookmark_from_row,
+        write_bookmarks_jsonl)
+from fake_moc_server import FakeMocServer
+
+FAKE_MOCP = os.path.join(ROOT, 'benchmarks', 'fake_mocp')
+PROGRAM = os.path.join(ROOT, 'mocp-bookmark-manager.py')
+BOOKMARKS_PER_FILE = 50
+FILES_PER_DIRECTORY = 100
+WORDS = ['intro', 'nice', 'classic', 'vocal', 'acid', 'ambient', 'break',
+        'live', 'remix', 'dub', 'Sven Väth', 'Laurent Garnier']
+SEARCHES = ['a', 'mix', 'show-042', 'acid live', 'nonexistent']
+
+def file_name(data_dir, rows, i):
+    return os.path.join(data_dir, 'audio-%d' % rows, 'show-%03d' % (i % FILES_PER_DIRECTORY),
+            'mix-%06d.mp3' % i)
+
+def synthetic_bookmarks(data_dir, rows):
+    rnd = random.Random(rows)
+    for i in range(rows):
+        comment = ' '.join(rnd.sample(WORDS, rnd.randint(0, 2)))
+        rating = rnd.choice([None, 1, 2, 3, 4, 5, 6])
+        yield (file_name(data_dir, rows, i // BOOKMARKS_PER_FILE),
+                (i % BOOKMARKS_PER_FILE) * 60 + rnd.randint(0, 59), rating, comment, None)
+
+def database(data_dir, rows):
+    """Path of the synthetic database of rows bookmarks, created if needed."""
+    path = os.path.join(data_dir, 'bookmarks-%d.sqlite' % rows)
+    if not os.path.exists(path):
+        print("generating %s" % path, file=sys.stderr)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        db = BookmarkDatabase(tmp_path)
+        db.import_bookmarks(synthetic_bookmarks(data_dir, rows))
+        # one rollback journal file is easier to copy around than WAL
+        db.conn.execute("PRAGMA journal_mode=DELETE")
+        db.close()
+        os.replace(tmp_path, path)
+    return path
+
+class Results:
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.entries = []
+
+    def time(self, name, rows, func, repeat=None, setup=None):
+        """Time func() repeat times, setup() untimed before each run."""
+        times = []
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            started = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - started) * 1000)
+        return self.add(name, rows, times)
+
+    def add(self, name, rows, times, **measures):
+        """Add an entry of times in milliseconds and further measures,
+        like rows_per_s, which compare() compares too."""
+        entry = { 'name': name, 'rows': rows, 'runs': len(times),
+                'min_ms': round(min(times), 3), 'median_ms': round(statistics.median(times), 3) }
+        entry.update(measures)
+        self.entries.append(entry)
+        print("%-40s %8d %10.2f %10.2f%s" % (name, rows, entry['min_ms'], entry['median_ms'],
+                ''.join('  %s %s' % item for item in measures.items())), file=sys.stderr)
+        return entry
+
+def sample_rows(db, count, seed=1):
+    """count random bookmarks, found by id since they are dense."""
+    max_id = db.conn.execute("SELECT max(id) FROM bookmarks").fetchone()[0]
+    rnd = random.Random(seed)
+    rows = []
+    while len(rows) < count:
+        row = db.get_bookmark(rnd.randint(1, max_id))
+        if row is not None:
+            rows.append(row)
+    return rows
+
+def bench_database(results, db, rows):
+    for search in SEARCHES:
+        results.time('get_filtered[%s]' % search, rows, lambda: db.get_filtered(search))
+    results.time('get_page[first]', rows, lambda: db.get_page(('id',), None, 'after', 100))
+    row = sample_rows(db, 1)[0]
+    results.time('get_page[middle]', rows, lambda: db.get_page(('id',), (row[0],), 'after', 100))
+
+def bench_update_view(results, path, rows):
+    from mocp_bookmarks_tui import BookmarkManager
+    app = BookmarkManager(path)
+    app.init_ui()
+    size = (120, 40)
+    def update_view(filter_string):
+        app.filter_string = filter_string
+        app.update_view()
+        app.bookmarks_listbox.render(size, focus=True)
+    for search in ['', 'mix', 'acid live']:
+        results.time('update_view[%s]' % search, rows, lambda: update_view(search))
+    app.filter_string = None
+    app.update_view()
+    def page_down():
+        app.bookmarks_listbox.keypress(size, 'page down')
+        app.bookmarks_listbox.render(size, focus=True)
+    results.time('list page down', rows, page_down, repeat=max(results.repeat, 50))
+    app.db.close()
+
+def bench_navigation(results, db, rows):
+    targets = sample_rows(db, 200, seed=2)
+    statuses = [PlayerStatus('PLAY', row[1], row[3] + 5, 3600, None) for row in targets]
+    player = PlayingController(db, MocController())
+    def navigate(index_warm):
+        if not index_warm:
+            player.positions.clear()
+        for status in statuses:
+            player.next_bookmark(status)
+            player.previous_bookmark(status)
+    results.time('next+previous x200 (cold index)', rows, lambda: navigate(False))
+    results.time('next+previous x200 (warm index)', rows, lambda: navigate(True))
+    def navigate_sql():
+        for status in statuses:
+            db.get_next_bookmark(status.file, status.current_sec)
+            db.get_previous_bookmark(status.file, status.current_sec)
+    results.time('next+previous x200 (sql)', rows, navigate_sql)
+
+def bench_play(results, db, rows, latencies, state_dir):
+    targets = [bookmark_from_row(row) for row in sample_rows(db, 10, seed=3)]
+    for latency in latencies:
+        os.environ['FAKE_MOCP_STATE'] = os.path.join(state_dir, 'fake-mocp-state.json')
+        os.environ['FAKE_MOCP_LATENCY'] = str(latency)
+        moc = MocController()
+        moc.mocp_binary = FAKE_MOCP
+        player = PlayingController(db, moc)
+        moc.start_moc_player()
+        queue = list(targets)
+        results.time('play_bookmark[mocp, %gs latency]' % latency, rows,
+                lambda: player.play_bookmark(queue.pop()), repeat=len(targets))
+
+    socket_path = os.path.join(state_dir, 'socket2')
+    for latency in latencies:
+        server = FakeMocServer(socket_path, latency=latency)
+        server.start()
+        moc = MocSocketController(socket_path)
+        player = PlayingController(db, moc)
+        queue = list(targets)
+        try:
+            results.time('play_bookmark[socket, %gs latency]' % latency, rows,
+                    lambda: player.play_bookmark(queue.pop()), repeat=len(targets))
+        finally:
+            moc.disconnect()
+            server.shutdown()
+            server.server_close()
+
+def bench_cue_export(results, path, data_dir, rows):
+    db = BookmarkDatabase(path)
+    for i in range(FILES_PER_DIRECTORY):
+        os.makedirs(os.path.dirname(file_name(data_dir, rows, i)), exist_ok=True)
+    exporter = CueExporter(db)
+    results.time('cue export --all', rows, lambda: exporter.export(everything=True), repeat=1)
+    names = [row[1] for row in sample_rows(db, 10, seed=4)]
+    def mark_dirty():
+        with db.batch():
+            db.conn.executemany("INSERT OR IGNORE INTO cue_dirty (name) VALUES (?)",
+                    [(name,) for name in names])
+    results.time('cue export, 10 files changed', rows, exporter.export, setup=mark_dirty)
+    db.close()
+
+def import_file(data_dir, rows):
+    """Path of the synthetic bookmarks as JSONL, written if needed."""
+    path = os.path.join(data_dir, 'bookmarks-%d.jsonl' % rows)
+    if not os.path.exists(path):
+        with open(path + '.tmp', 'wt', encoding='utf-8') as f:
+            write_bookmarks_jsonl(synthetic_bookmarks(data_dir, rows), f)
+        os.replace(path + '.tmp', path)
+    return path
+
+def run_import(db_path, path):
+    """Run the import command, return its seconds and peak RSS in MB."""
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, PROGRAM, '--database', db_path, 'import', path],
+            stdout=subprocess.DEVNULL)
+    # wait4() reports the resources of this child alone
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError("import of %s failed with %d" % (path, process.returncode))
+    # ru_maxrss is in KB on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+def bench_import(results, data_dir, work_dir, rows):
+    """Import into an empty database, then the same file again, which
+    adds nothing."""
+    path = import_file(data_dir, rows)
+    db_path = os.path.join(work_dir, 'import.sqlite')
+    for name in ('import jsonl', 'import jsonl again'):
+        seconds, max_rss_mb = run_import(db_path, path)
+        results.add(name, rows, [seconds * 1000], rows_per_s=round(rows / seconds),
+                max_rss_mb=round(max_rss_mb, 1))
+    for name in os.listdir(work_dir):
+        if name.startswith('import.sqlite'):
+            os.unlink(os.path.join(work_dir, name))
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True,
+                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(entries, old_path):
+    with open(old_path) as f:
+        old = { (e['name'], e['rows']): e for e in json.load(f)['results'] }
+    print("%-40s %8s %10s %10s %8s" % ('', 'rows', 'old ms', 'new ms', 'ratio'))
+    for entry in entries:
+        before = old.get((entry['name'], entry['rows']))
+        if before is None:
+            continue
+        ratio = entry['median_ms'] / before['median_ms'] if before['median_ms'] else float('inf')
+        print("%-40s %8d %10.2f %10.2f %7.2fx" % (entry['name'], entry['rows'],
+                before['median_ms'], entry['median_ms'], ratio))
+        for measure in ('rows_per_s', 'max_rss_mb'):
+            if measure in entry and measure in before:
+                ratio = entry[measure] / before[measure] if before[measure] else float('inf')
+                print("%-40s %8s %10s %10s %7.2fx" % ('    ' + measure, '',
+                        before[measure], entry[measure], ratio))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmarks.")
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+            help="comma separated database sizes in rows")
+    parser.add_argument('--latency', default='0,0.05',
+            help="comma separated seconds the fake players wait before answering")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement")
+    parser.add_argument('--data-dir',
+            default=os.path.join(tempfile.gettempdir(), 'mocp-bookmark-manager-bench'),
+            help="where generated databases are kept")
+    parser.add_argument('--output', '-o', help="JSON file for the results (default: stdout)")
+    parser.add_argument('--compare', metavar='JSON', help="results of an earlier run to compare with")
+    parser.add_argument('--skip', default='',
+            help="comma separated groups not to run: database,view,navigation,play,cue,import")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    latencies = [float(latency) for latency in args.latency.split(',')]
+    skip = set(args.skip.split(','))
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = Results(args.repeat)
+    with tempfile.TemporaryDirectory() as work_dir:
+        for rows in sizes:
+            # every size runs on a fresh copy, the benchmarks write to it
+            path = os.path.join(work_dir, 'bookmarks.sqlite')
+            shutil.copyfile(database(args.data_dir, rows), path)
+            db = BookmarkDatabase(path)
+            if 'database' not in skip:
+                bench_database(results, db, rows)
+            if 'view' not in skip:
+                bench_update_view(results, path, rows)
+            if 'navigation' not in skip:
+                bench_navigation(results, db, rows)
+            if 'play' not in skip:
+                bench_play(results, db, rows, latencies, work_dir)
+            db.close()
+            if 'cue' not in skip:
+                bench_cue_export(results, path, args.data_dir, rows)
+            if 'import' not in skip:
+                bench_import(results, args.data_dir, work_dir, rows)
+            for name in os.listdir(work_dir):
+                if name.startswith('bookmarks.sqlite'):
+                    os.unlink(os.path.join(work_dir, name))
+
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+        'results': results.entries,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        compare(results.entries, args.compare)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
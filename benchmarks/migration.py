@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#encoding=utf-8
+"""Check that migrating a database of the original schema turns the
+bookmark lookups and the pages of rating and pos searches into index
+seeks.
+
+    ./benchmarks/migration.py [--bookmarks 1000000] [--keep FILE]
+
+A database of --bookmarks rows is created with the schema the first
+versions of the program used, a bookmarks table without indexes, and
+opened with BookmarkDatabase, which migrates it. The statements
+get_next_bookmark() and get_previous_bookmark() run are captured and
+their query plans checked: a search of the (name, position) index,
+where the original lookup scanned the table. So are those of the
+second page of rating and pos searches: a search of the (rating, id) or
+(position, id) index for those matching few bookmarks or an equal
+value, where they scanned the table in id order. Exits with 1 if a
+plan isn't the expected one.
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mocp_bookmarks import BookmarkDatabase, bookmark_source
+
+BOOKMARKS_PER_FILE = 50
+INDEX_SEEK = 'SEARCH bookmarks USING INDEX bookmarks_name_position (name=? AND position'
+# searches and the plans of their second page with the default
+# --bookmarks: every 50th bookmark is at 49m, a sixth is rated 5. An
+# equal value seeks its bookmarks in id order, a range with few matches
+# finds them through the index and sorts them.
+SEARCH_PLANS = [
+    ('rating:5', 'SEARCH bookmarks USING INDEX bookmarks_rating_id (rating=? AND id>?)'),
+    ('rating:none', 'SEARCH bookmarks USING INDEX bookmarks_rating_id (rating=? AND id>?)'),
+    ('pos:49m', 'SEARCH bookmarks USING INDEX bookmarks_position_id (position=? AND id>?)'),
+    ('rating>=5 pos>48m', 'SEARCH bookmarks USING INDEX bookmarks_position_id (position>?) / USE TEMP B-TREE FOR ORDER BY'),
+    # common matches are found quickest by reading in id order
+    ('rating>=4', 'SEARCH bookmarks USING INTEGER PRIMARY KEY (rowid>?)'),
+]
+
+def create_baseline_database(path, bookmarks):
+    """A database like the first versions of the program created."""
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE IF NOT EXISTS bookmarks (id INTEGER PRIMARY KEY, datetime_created TEXT, name TEXT, position INTEGER, rating INTEGER, comment TEXT)''')
+    rnd = random.Random(bookmarks)
+    conn.executemany("INSERT INTO bookmarks (datetime_created, name, rating, position, comment) VALUES (datetime('now'), ?, ?, ?, ?)",
+            (('/music/show-%03d/mix-%06d.mp3' % (i // BOOKMARKS_PER_FILE % 100, i // BOOKMARKS_PER_FILE),
+                rnd.choice([None, 1, 2, 3, 4, 5]), (i % BOOKMARKS_PER_FILE) * 60, '')
+                for i in range(bookmarks)))
+    conn.commit()
+    conn.close()
+
+def lookup_statements(db, filename, position):
+    """The statements the lookups run, with their values filled in."""
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    try:
+        db.get_next_bookmark(filename, position)
+        db.get_previous_bookmark(filename, position)
+    finally:
+        db.conn.set_trace_callback(None)
+    return [s for s in statements if s.lstrip().upper().startswith('SELECT')]
+
+def search_statements(db, search):
+    """The statements reading the second page of search, and its time."""
+    source = bookmark_source(db, search)
+    rows = source.rows()
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    started = time.perf_counter()
+    try:
+        source.rows(source.key(rows[-1]) if rows else None)
+    finally:
+        db.conn.set_trace_callback(None)
+    return ([s for s in statements if s.lstrip().upper().startswith('SELECT')],
+            (time.perf_counter() - started) * 1000)
+
+def query_plans(conn, statements):
+    return [' / '.join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + statement))
+            for statement in statements]
+
+def time_lookups(lookup, targets):
+    times = []
+    for filename, position in targets:
+        started = time.perf_counter()
+        lookup(filename, position)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the query plans of migrated databases.")
+    parser.add_argument('--bookmarks', type=int, default=1000000)
+    parser.add_argument('--keep', metavar='FILE', help="create the database here and keep it")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = args.keep or os.path.join(work_dir, 'bookmarks.sqlite')
+        if os.path.exists(path):
+            os.unlink(path)
+        started = time.perf_counter()
+        create_baseline_database(path, args.bookmarks)
+        print("created %d bookmarks in %.1fs" % (args.bookmarks, time.perf_counter() - started),
+                file=sys.stderr)
+
+        rnd = random.Random(1)
+        files = args.bookmarks // BOOKMARKS_PER_FILE
+        targets = [('/music/show-%03d/mix-%06d.mp3' % (i % 100, i), rnd.randint(0, 3000))
+                for i in (rnd.randrange(files) for _ in range(20))]
+        baseline = sqlite3.connect(path)
+        baseline_statement = "SELECT id, name, rating, position, comment FROM bookmarks WHERE name=? AND position > ? ORDER BY position ASC LIMIT 1"
+        def baseline_lookup(filename, position):
+            baseline.execute(baseline_statement, (filename, position)).fetchall()
+        before_ms = time_lookups(baseline_lookup, targets)
+        before_plan = ' / '.join(row[3] for row in
+                baseline.execute("EXPLAIN QUERY PLAN " + baseline_statement, targets[0]))
+        baseline.close()
+
+        started = time.perf_counter()
+        db = BookmarkDatabase(path)
+        print("migrated in %.1fs" % (time.perf_counter() - started), file=sys.stderr)
+        statements = lookup_statements(db, *targets[0])
+        plans = query_plans(db.conn, statements)
+        after_ms = time_lookups(db.get_next_bookmark, targets)
+        searches = [(search, expected) + search_statements(db, search)
+                for search, expected in SEARCH_PLANS]
+        searches = [(search, expected, statements, query_plans(db.conn, statements), page_ms)
+                for search, expected, statements, page_ms in searches]
+        db.close()
+
+    print("before migrating:\n    %s" % before_plan)
+    failed = 0
+    for statement, plan in zip(statements, plans):
+        ok = plan.startswith(INDEX_SEEK)
+        failed += not ok
+        print("%s  %s\n    %s" % ('ok  ' if ok else 'FAIL', statement, plan))
+    if len(plans) != 2:
+        print("FAIL  expected 2 lookup statements, got %d" % len(plans))
+        failed += 1
+    print("next bookmark lookup, median of %d: %.3f ms before, %.3f ms after migrating"
+            % (len(targets), before_ms, after_ms))
+    for search, expected, statements, plans, page_ms in searches:
+        ok = plans == [expected]
+        failed += not ok
+        print("%s  %s: second page in %.1f ms\n    %s" % ('ok  ' if ok else 'FAIL', search, page_ms,
+                '\n    '.join(plans) or 'no statement'))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+#encoding=utf-8
+"""Time the headless commands as a window manager hotkey would run them.
+
+    ./benchmarks/startup.py [--runs 20] [--bookmarks 10000]
+
+Every command is started as a new process against a database of
+--bookmarks rows and tools/fake_moc_server.py, which answers without
+delay, so the times are the startup and work of the command itself.
+A bare interpreter start is timed too, for comparison.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+from mocp_bookmarks import BookmarkDatabase, DATABASE_PATH
+from fake_moc_server import FakeMocServer
+
+SCRIPT = os.path.join(ROOT, 'mocp-bookmark-manager.py')
+PLAYING_FILE = '/music/mix-0000.mp3'
+
+COMMANDS = [
+    ('python -c pass', [sys.executable, '-c', 'pass']),
+    ('list --playing', [sys.executable, SCRIPT, 'list', '--playing']),
+    ('search', [sys.executable, SCRIPT, 'search', 'mix']),
+    ('add', [sys.executable, SCRIPT, 'add']),
+    ('next', [sys.executable, SCRIPT, 'next']),
+    ('prev', [sys.executable, SCRIPT, 'prev']),
+]
+
+def create_database(path, bookmarks):
+    db = BookmarkDatabase(path)
+    db.import_bookmarks(('/music/mix-%04d.mp3' % (i // 50), (i % 50) * 60, i % 7, '', None)
+            for i in range(bookmarks))
+    db.close()
+
+def time_command(argv, env, runs):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - started) * 1000)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the startup of the headless commands.")
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--bookmarks', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(os.environ, HOME=home)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        os.makedirs(os.path.join(home, '.moc'))
+        database_path = DATABASE_PATH.replace('~', home, 1)
+        os.makedirs(os.path.dirname(database_path))
+        create_database(database_path, args.bookmarks)
+
+        server = FakeMocServer(os.path.join(home, '.moc', 'socket2'))
+        server.player.play(PLAYING_FILE)
+        server.player.jump(20 * 60)
+        server.start()
+        try:
+            # a first run writes the bytecode caches
+            subprocess.run([sys.executable, SCRIPT, 'list', '--playing'], env=env,
+                    stdout=subprocess.DEVNULL)
+            print("%-16s %8s %8s" % ('command', 'min ms', 'median'))
+            for name, argv in COMMANDS:
+                times = time_command(argv, env, args.runs)
+                print("%-16s %8.1f %8.1f" % (name, min(times), statistics.median(times)))
+        finally:
+            server.shutdown()
+            server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
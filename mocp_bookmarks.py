@@ -0,0 +1,2745 @@
+#encoding=utf-8
+
+import sys
+import sqlite3
+from os.path import expanduser
+import os
+import struct
+import time
+import collections
+import functools
+import bisect
+import contextlib
+import itertools
+
+MAX_RATING=6
+# seconds after a bookmark within which 'previous' skips back past it
+ZAPPING_TOLERANCE=1
+DATABASE_PATH='~/Radio_X/mocp-bookmarks.sqlite'
+
+# subset of the MOC server protocol (protocol.h of moc 2.5/2.6)
+MOC_CMD_PLAY = 0x00
+MOC_CMD_LIST_CLEAR = 0x01
+MOC_CMD_LIST_ADD = 0x02
+MOC_CMD_PAUSE = 0x05
+MOC_CMD_UNPAUSE = 0x06
+MOC_CMD_GET_CTIME = 0x0d
+MOC_CMD_GET_SNAME = 0x0f
+MOC_CMD_SEEK = 0x12
+MOC_CMD_GET_STATE = 0x13
+MOC_CMD_DISCONNECT = 0x15
+MOC_CMD_GET_MIXER = 0x1a
+MOC_CMD_GET_TAGS = 0x2c
+MOC_CMD_JUMP_TO = 0x3a
+
+MOC_EV_DATA = 0x06
+# asynchronous events the server may send before the reply to a request
+MOC_PLAIN_EVENTS = (0x01, 0x02, 0x05, 0x07, 0x08, 0x09, 0x0a, 0x0b, 0x0c,
+        0x0d, 0x0e, 0x10, 0x12, 0x13, 0x14)
+MOC_STRING_EVENTS = (0x04, 0x0f)
+
+MOC_STATES = { 0x01: 'PLAY', 0x02: 'STOP', 0x03: 'PAUSE' }
+MOC_MAX_STRING = 4096
+
+class PlayerStatus(collections.namedtuple('PlayerStatus',
+        ['state', 'file', 'current_sec', 'total_sec', 'volume'])):
+    """Snapshot of the player taken by a single status query.
+
+    state is 'PLAY', 'PAUSE', 'STOP', 'not running' or an error message.
+    Seconds are -1 and file is None when the player doesn't report them,
+    volume is None when the backend can't query the mixer.
+    """
+
+    @property
+    def is_running(self):
+        return self.state in ('PLAY', 'PAUSE', 'STOP')
+
+    @property
+    def has_file(self):
+        return self.state in ('PLAY', 'PAUSE') and self.file is not None
+
+    def describe(self):
+        if self.state == 'PLAY':
+            return "%s, position: %ss" % (self.state, self.current_sec)
+        return self.state
+
+    def volume_bar(self):
+        bars = '▁▂▃▄▅▆▇█'
+        if self.volume is None:
+            return bars
+        return bars[:max(1, round(len(bars) * self.volume / 100))]
+
+def format_timings(timings):
+    return ', '.join('%s %dms%s' % (step, seconds * 1000, '' if confirmed else ' (unconfirmed)')
+            for step, seconds, confirmed in timings)
+
+def bookmark_from_row(row):
+    return { 'id': row[0], "filename": row[1], "position": row[3], "rating": row[2], "comment": row[4] }
+
+class LatencyHistogram:
+    """Count, total, maximum and a log2 histogram of durations.
+
+    Bucket i counts the durations of less than 2**i microseconds that
+    didn't fit into bucket i - 1, so recording is a few integer
+    operations and percentiles are exact to a factor of two.
+    """
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    bucket_count = 40
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * self.bucket_count
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1000000).bit_length(), self.bucket_count - 1)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the duration fraction of the samples stay below."""
+        remaining = fraction * self.count
+        for i, count in enumerate(self.buckets):
+            remaining -= count
+            if remaining <= 0:
+                return min(2 ** i / 1000000, self.max)
+        return self.max
+
+    def as_dict(self):
+        return { 'count': self.count, 'total_ms': self.total * 1000, 'max_ms': self.max * 1000,
+                'p50_ms': self.percentile(0.5) * 1000, 'p99_ms': self.percentile(0.99) * 1000,
+                'buckets_us': { 2 ** i: count for i, count in enumerate(self.buckets) if count } }
+
+class LatencyStats:
+    """Latency histograms by name, of player commands, queries and redraws.
+
+    Recording takes no lock, counts may be off by one when two threads
+    record the same name at the same moment.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def timed(self, prefix, name=None):
+        """Decorator recording the calls of a function as '<prefix> <name>',
+        name defaults to the function's."""
+        def decorator(func):
+            full_name = '%s %s' % (prefix, name or func.__name__)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(full_name, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def clear(self):
+        self.histograms.clear()
+
+    def format(self):
+        """Return a table of the histograms as lines of text, most total time first."""
+        lines = ['%-30s %7s %8s %8s %8s %9s' % ('', 'count', 'p50 ms', 'p99 ms', 'max ms', 'total ms')]
+        for name, h in sorted(self.histograms.items(), key=lambda item: -item[1].total):
+            lines.append('%-30s %7d %8.2f %8.2f %8.2f %9.0f' % (name[:30], h.count,
+                    h.percentile(0.5) * 1000, h.percentile(0.99) * 1000, h.max * 1000, h.total * 1000))
+        return lines
+
+    def dump(self, path):
+        import json
+        with open(path, 'wt') as f:
+            json.dump({ name: h.as_dict() for name, h in sorted(self.histograms.items()) }, f, indent=2)
+            f.write('\n')
+
+latency_stats = LatencyStats()
+timed = latency_stats.timed
+
+class MocController():
+
+    mocp_binary = '/usr/bin/mocp'
+    max_retries = 5
+    # seconds a status snapshot is reused before mocp is queried again
+    status_ttl = 0.25
+    # all status fields are fetched with one 'mocp -Q' call, separated by
+    # a control character which doesn't show up in file names
+    status_separator = '\x1f'
+    status_fields = ['%state', '%file', '%cs', '%ts']
+    # seconds after which a hanging mocp process is given up on
+    command_timeout = 10
+    # waiting for the player to confirm a command: polls start every
+    # wait_initial_interval seconds and back off to wait_max_interval
+    wait_timeout = 3.0
+    wait_initial_interval = 0.01
+    wait_max_interval = 0.2
+    # seconds the reported position may differ from a jump target
+    position_tolerance = 2
+
+    def __init__(self):
+        self._status = None
+        self._status_time = 0.0
+        self.last_timings = []
+
+    def _run(self, *args):
+        import subprocess
+        started = time.perf_counter()
+        try:
+            proc = subprocess.run([self.mocp_binary] + [str(a) for a in args],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    timeout=self.command_timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return 127, '', [str(e)]
+        finally:
+            latency_stats.record('mocp %s' % args[0], time.perf_counter() - started)
+        stdout = proc.stdout.decode('utf-8', 'replace').rstrip('\n')
+        stderr = proc.stderr.decode('utf-8', 'replace').splitlines()
+        return proc.returncode, stdout, stderr
+
+    def _parse_seconds(self, value):
+        try:
+            return int(value)
+        except ValueError:
+            return -1
+
+    def _query_status(self):
+        returncode, stdout, stderr = self._run('-Q',
+                self.status_separator.join(self.status_fields))
+        fields = stdout.split(self.status_separator)
+        if returncode == 0 and len(fields) == len(self.status_fields):
+            state, filename, current_sec, total_sec = fields
+            return PlayerStatus(state, filename or None,
+                    self._parse_seconds(current_sec),
+                    self._parse_seconds(total_sec), None)
+
+        if any("server is not running" in line for line in stderr):
+            state = "not running"
+        elif len(stderr) > 0:
+            state = stderr[0]
+        else:
+            state = "error"
+        return PlayerStatus(state, None, -1, -1, None)
+
+    def get_status(self, max_age=None):
+        """Return a player status snapshot no older than max_age seconds.
+
+        Control commands invalidate the snapshot, so the next call after
+        e.g. a seek always queries the player.
+        """
+        if max_age is None:
+            max_age = self.status_ttl
+        now = time.monotonic()
+        if self._status is None or now - self._status_time > max_age:
+            self._status = self._query_status()
+            self._status_time = now
+        return self._status
+
+    def invalidate_status(self):
+        self._status = None
+
+    def get_volume(self):
+        return self.get_status().volume_bar()
+
+    def get_player_state(self):
+        return self.get_status().describe()
+
+    def toggle_pause(self):
+        self._run('--toggle-pause')
+        self.invalidate_status()
+
+    def play_file(self, filepath):
+        if not self.get_status().is_running:
+            self.start_moc_player()
+        returncode, stdout, stderr = self._run('-l', filepath)
+        self.invalidate_status()
+        return returncode == 0
+    
+    def start_moc_player(self):
+        import subprocess
+        subprocess.Popen([self.mocp_binary, '--server'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_for(lambda status: status.is_running)
+
+    def jump_to_second(self, second):
+        self._run('-j', '%ss' % second)
+        self.invalidate_status()
+
+    def rewind(self, seconds):
+        self._run('--seek', -seconds)
+        self.invalidate_status()
+
+    def skip(self, seconds):
+        self._run('--seek', seconds)
+        self.invalidate_status()
+
+    def get_playing_file(self):
+        return self.get_status().file
+
+    def get_playing_pos(self):
+        return self.get_status().current_sec
+
+    def wait_for(self, condition, timeout=None):
+        """Poll the player until condition(status) holds or timeout passes.
+
+        The first polls follow each other quickly and back off up to
+        wait_max_interval, so a player that is ready at once costs one
+        query. Returns the last status and whether the condition held.
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        deadline = time.monotonic() + timeout
+        interval = self.wait_initial_interval
+        while True:
+            status = self.get_status(max_age=0)
+            if condition(status):
+                return status, True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return status, False
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.wait_max_interval)
+
+    def _timed_step(self, timings, step, command, condition):
+        started = time.perf_counter()
+        command()
+        status, confirmed = self.wait_for(condition)
+        timings.append((step, time.perf_counter() - started, confirmed))
+        return confirmed
+
+    @timed('moc')
+    def play_at(self, filepath, second):
+        """Play filepath from second, confirming every step with the player.
+
+        Returns the (step, seconds, confirmed) timings of the steps taken,
+        they are also kept in last_timings.
+        """
+        timings = []
+
+        def is_playing_file(status):
+            return status.state == 'PLAY' and status.file == filepath
+
+        def is_at_position(status):
+            return is_playing_file(status) and \
+                    abs(status.current_sec - second) <= self.position_tolerance
+
+        if not is_playing_file(self.get_status(max_age=0)):
+            self._timed_step(timings, 'play file',
+                    lambda: self.play_file(filepath), is_playing_file)
+
+        # a jump right after loading a file can get lost, so it's sent a
+        # second time if the player doesn't confirm the first one
+        if not self._timed_step(timings, 'jump',
+                lambda: self.jump_to_second(second), is_at_position):
+            self._timed_step(timings, 'jump again',
+                    lambda: self.jump_to_second(second), is_at_position)
+
+        self.last_timings = timings
+        # logging is slow to import and can only be configured by someone
+        # who imported it already
+        logging = sys.modules.get('logging')
+        if logging is not None:
+            logging.getLogger('mocp-bookmark-manager').debug("play_at %s@%ss: %s",
+                    filepath, second, format_timings(timings))
+        return timings
+
+
+class MocSocketController(MocController):
+    """MocController talking to the MOC server over its UNIX socket.
+
+    All commands and queries share one persistent connection. Whenever the
+    socket can't be used the subprocess implementation is used instead, so
+    this class is a drop-in replacement for MocController.
+    """
+
+    socket_path = expanduser('~/.moc/socket2')
+    socket_timeout = 2.0
+
+    def __init__(self, socket_path=None):
+        MocController.__init__(self)
+        if socket_path is not None:
+            self.socket_path = socket_path
+        self._sock = None
+
+    def _connect(self):
+        if self._sock is None:
+            # the C module behind socket, which would also import enum
+            # for its constants; its sockets have all the methods used here
+            import _socket
+            sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+            sock.settimeout(self.socket_timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def disconnect(self):
+        if self._sock is not None:
+            try:
+                self._send(MOC_CMD_DISCONNECT)
+            except OSError:
+                pass
+            self._close()
+
+    def _send(self, *values):
+        packet = bytearray()
+        for value in values:
+            if isinstance(value, str):
+                data = value.encode('utf-8')
+                packet += struct.pack('=i', len(data)) + data
+            else:
+                packet += struct.pack('=i', value)
+        self._sock.sendall(packet)
+
+    def _recv_exact(self, size):
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self._sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError("MOC server closed the connection")
+            buf += chunk
+        return bytes(buf)
+
+    def _recv_int(self):
+        return struct.unpack('=i', self._recv_exact(4))[0]
+
+    def _recv_str(self):
+        size = self._recv_int()
+        if size < 0 or size > MOC_MAX_STRING:
+            raise ConnectionError("invalid string length %d from MOC server" % size)
+        return self._recv_exact(size).decode('utf-8', 'replace')
+
+    def _recv_data(self):
+        """Skip asynchronous events up to the EV_DATA reply of a request."""
+        while True:
+            event = self._recv_int()
+            if event == MOC_EV_DATA:
+                return
+            elif event in MOC_STRING_EVENTS:
+                self._recv_str()
+            elif event not in MOC_PLAIN_EVENTS:
+                raise ConnectionError("unexpected event 0x%02x from MOC server" % event)
+
+    def _request(self, fallback, request, *args):
+        """Run request on the connection, reconnecting once if it dropped.
+
+        fallback is the MocController method to use when the server can't
+        be reached through the socket.
+        """
+        with latency_stats.timer(request.__name__.replace('_socket_', 'socket ')):
+            for attempt in range(2):
+                try:
+                    self._connect()
+                    return request(*args)
+                except OSError:
+                    self._close()
+        return fallback(self, *args)
+
+    def _socket_status(self):
+        self._send(MOC_CMD_GET_STATE, MOC_CMD_GET_SNAME, MOC_CMD_GET_CTIME,
+                MOC_CMD_GET_TAGS, MOC_CMD_GET_MIXER)
+        self._recv_data()
+        state = MOC_STATES.get(self._recv_int(), "error")
+        self._recv_data()
+        filename = self._recv_str()
+        self._recv_data()
+        current_sec = self._recv_int()
+        self._recv_data()
+        # tags: title, artist, album, track, time, filled
+        self._recv_str()
+        self._recv_str()
+        self._recv_str()
+        self._recv_int()
+        total_sec = self._recv_int()
+        self._recv_int()
+        self._recv_data()
+        volume = self._recv_int()
+        return PlayerStatus(state, filename or None, current_sec, total_sec, volume)
+
+    def _query_status(self):
+        return self._request(MocController._query_status, self._socket_status)
+
+    def _socket_toggle_pause(self):
+        self._send(MOC_CMD_GET_STATE)
+        self._recv_data()
+        if self._recv_int() == 0x03:
+            self._send(MOC_CMD_UNPAUSE)
+        else:
+            self._send(MOC_CMD_PAUSE)
+
+    def toggle_pause(self):
+        self._request(MocController.toggle_pause, self._socket_toggle_pause)
+        self.invalidate_status()
+
+    def _socket_play_file(self, filepath):
+        self._send(MOC_CMD_LIST_CLEAR, MOC_CMD_LIST_ADD, filepath,
+                MOC_CMD_PLAY, filepath)
+        return True
+
+    def play_file(self, filepath):
+        if not self.get_status().is_running:
+            self.start_moc_player()
+        result = self._request(MocController.play_file, self._socket_play_file, filepath)
+        self.invalidate_status()
+        return result
+
+    def _socket_jump_to_second(self, second):
+        self._send(MOC_CMD_JUMP_TO, int(second))
+
+    def jump_to_second(self, second):
+        self._request(MocController.jump_to_second, self._socket_jump_to_second, second)
+        self.invalidate_status()
+
+    def _socket_seek(self, seconds):
+        self._send(MOC_CMD_SEEK, int(seconds))
+
+    def rewind(self, seconds):
+        self._request(MocController.rewind, self._socket_rewind, seconds)
+        self.invalidate_status()
+
+    def _socket_rewind(self, seconds):
+        self._socket_seek(-seconds)
+
+    def skip(self, seconds):
+        self._request(MocController.skip, self._socket_seek, seconds)
+        self.invalidate_status()
+
+class BookmarkDatabase:
+
+    # migrations[n] brings the schema from version n to n + 1
+    migrations = [
+        [
+            '''CREATE TABLE IF NOT EXISTS bookmarks (id INTEGER PRIMARY KEY, datetime_created TEXT, name TEXT, position INTEGER, rating INTEGER, comment TEXT)''',
+            '''CREATE INDEX IF NOT EXISTS bookmarks_name_position ON bookmarks (name, position)''',
+            '''CREATE INDEX IF NOT EXISTS bookmarks_rating ON bookmarks (rating)''',
+        ],
+        [
+            # full text index over file basename, directory and comment,
+            # the path is split with rtrim() since SQLite has no basename().
+            # Prefix indexes keep search-as-you-type fast for short input.
+            '''CREATE VIRTUAL TABLE bookmarks_fts USING fts5(basename, directory, comment, prefix='1 2 3')''',
+            '''INSERT INTO bookmarks_fts (rowid, basename, directory, comment)
+                SELECT id, replace(name, rtrim(name, replace(name, '/', '')), ''),
+                    rtrim(name, replace(name, '/', '')), comment FROM bookmarks''',
+            '''CREATE TRIGGER bookmarks_fts_insert AFTER INSERT ON bookmarks BEGIN
+                INSERT INTO bookmarks_fts (rowid, basename, directory, comment)
+                VALUES (new.id, replace(new.name, rtrim(new.name, replace(new.name, '/', '')), ''),
+                    rtrim(new.name, replace(new.name, '/', '')), new.comment);
+            END''',
+            '''CREATE TRIGGER bookmarks_fts_delete AFTER DELETE ON bookmarks BEGIN
+                DELETE FROM bookmarks_fts WHERE rowid = old.id;
+            END''',
+            '''CREATE TRIGGER bookmarks_fts_update AFTER UPDATE OF name, comment ON bookmarks BEGIN
+                UPDATE bookmarks_fts SET
+                    basename = replace(new.name, rtrim(new.name, replace(new.name, '/', '')), ''),
+                    directory = rtrim(new.name, replace(new.name, '/', '')),
+                    comment = new.comment
+                WHERE rowid = new.id;
+            END''',
+        ],
+        [
+            # files whose cue sheet has to be rewritten
+            '''CREATE TABLE cue_dirty (name TEXT PRIMARY KEY) WITHOUT ROWID''',
+            '''INSERT OR IGNORE INTO cue_dirty (name) SELECT name FROM bookmarks''',
+            '''CREATE TRIGGER cue_dirty_insert AFTER INSERT ON bookmarks BEGIN
+                INSERT OR IGNORE INTO cue_dirty (name) VALUES (new.name);
+            END''',
+            '''CREATE TRIGGER cue_dirty_update AFTER UPDATE OF name, position ON bookmarks BEGIN
+                INSERT OR IGNORE INTO cue_dirty (name) VALUES (old.name);
+                INSERT OR IGNORE INTO cue_dirty (name) VALUES (new.name);
+            END''',
+            '''CREATE TRIGGER cue_dirty_delete AFTER DELETE ON bookmarks BEGIN
+                INSERT OR IGNORE INTO cue_dirty (name) VALUES (old.name);
+            END''',
+        ],
+        [
+            # content fingerprints of bookmarked files, to find them again
+            # after they were moved, see FileRelinker
+            '''CREATE TABLE file_fingerprints (name TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, fingerprint BLOB NOT NULL) WITHOUT ROWID''',
+            '''CREATE INDEX file_fingerprints_fingerprint ON file_fingerprints (fingerprint)''',
+        ],
+        [
+            # whether bookmarked files exist, their size, mtime and duration,
+            # see FileMetadataStore. checked is the unix time of the last
+            # stat, 0 for never.
+            '''CREATE TABLE file_metadata (name TEXT PRIMARY KEY, present INTEGER, size INTEGER, mtime_ns INTEGER, duration REAL, checked REAL NOT NULL DEFAULT 0) WITHOUT ROWID''',
+            '''CREATE INDEX file_metadata_checked ON file_metadata (checked)''',
+            '''INSERT INTO file_metadata (name) SELECT DISTINCT name FROM bookmarks''',
+            '''CREATE TRIGGER file_metadata_insert AFTER INSERT ON bookmarks BEGIN
+                INSERT OR IGNORE INTO file_metadata (name) VALUES (new.name);
+            END''',
+            '''CREATE TRIGGER file_metadata_update AFTER UPDATE OF name ON bookmarks BEGIN
+                INSERT OR IGNORE INTO file_metadata (name) VALUES (new.name);
+                DELETE FROM file_metadata WHERE name = old.name
+                    AND NOT EXISTS (SELECT 1 FROM bookmarks WHERE name = old.name);
+            END''',
+            '''CREATE TRIGGER file_metadata_delete AFTER DELETE ON bookmarks BEGIN
+                DELETE FROM file_metadata WHERE name = old.name
+                    AND NOT EXISTS (SELECT 1 FROM bookmarks WHERE name = old.name);
+            END''',
+        ],
+        [
+            # unix time a bookmarked file was last played, for FileIndex
+            '''ALTER TABLE file_metadata ADD COLUMN played REAL''',
+        ],
+        [
+            # what was played from where to where, a ring buffer of
+            # PlaybackHistory.capacity entries: entry seq is stored in
+            # slot seq % capacity
+            '''CREATE TABLE playback_history (slot INTEGER PRIMARY KEY, seq INTEGER NOT NULL, name TEXT NOT NULL, start_position INTEGER NOT NULL, position INTEGER NOT NULL, started REAL NOT NULL, updated REAL NOT NULL)''',
+            '''CREATE UNIQUE INDEX playback_history_seq ON playback_history (seq)''',
+        ],
+        [
+            # when a file reached by a jump in played order was played
+            # before, where FileIndex keeps it in that order
+            '''ALTER TABLE file_metadata ADD COLUMN previous_played REAL''',
+        ],
+        [
+            # rating and pos searches with few matches seek these and sort
+            # the matches by id, see bookmark_source(). (rating, id) also
+            # does all the rating index did.
+            '''DROP INDEX IF EXISTS bookmarks_rating''',
+            '''CREATE INDEX bookmarks_rating_id ON bookmarks (rating, id)''',
+            '''CREATE INDEX bookmarks_position_id ON bookmarks (position, id)''',
+        ],
+        [
+            # a renamed file, like a relinked one, keeps its duration and
+            # when it was played; it is checked again soon, as checked is 0
+            '''DROP TRIGGER file_metadata_update''',
+            '''CREATE TRIGGER file_metadata_update AFTER UPDATE OF name ON bookmarks BEGIN
+                INSERT OR IGNORE INTO file_metadata (name, size, mtime_ns, duration, played, previous_played)
+                    SELECT new.name, size, mtime_ns, duration, played, previous_played
+                    FROM file_metadata WHERE name = old.name;
+                INSERT OR IGNORE INTO file_metadata (name) VALUES (new.name);
+                DELETE FROM file_metadata WHERE name = old.name
+                    AND NOT EXISTS (SELECT 1 FROM bookmarks WHERE name = old.name);
+            END''',
+        ],
+    ]
+
+    comparison_operators = ('=', '!=', '<', '<=', '>', '>=')
+    # seconds to wait for another instance's write lock
+    busy_timeout = 5.0
+    # WAL lets instances read while another one writes. It relies on shared
+    # memory, so it only works between processes on one host: use 'DELETE'
+    # for a database opened by several machines over a network share.
+    journal_mode = 'WAL'
+    # bm25 weights of the basename, directory and comment columns
+    search_weights = (10.0, 2.0, 5.0)
+    search_limit = 1000
+    # searches matching more bookmarks than this are listed in id order,
+    # not ranked: ranking happens on the UI thread after every pause in
+    # typing and adds about 5ms per 1000 matches to finding them
+    search_rank_limit = 2000
+    # rating and pos searches matching up to this many bookmarks seek the
+    # rating or position index and sort the matches of a page, those
+    # matching more scan the bookmarks in order, see bookmark_source()
+    filter_sort_limit = 10000
+
+    # insert triggers import_bookmarks() replaces by a statement doing the
+    # same for all new rows, the ones with id >= ?, at once. That is several
+    # times faster than row by row. Dropping the triggers is part of the
+    # import transaction, other connections never see them missing.
+    bulk_insert_statements = {
+        'bookmarks_fts_insert': '''INSERT INTO bookmarks_fts (rowid, basename, directory, comment)
+            SELECT id, replace(name, rtrim(name, replace(name, '/', '')), ''),
+                rtrim(name, replace(name, '/', '')), comment FROM bookmarks WHERE id >= ?''',
+        'cue_dirty_insert': '''INSERT OR IGNORE INTO cue_dirty (name) SELECT DISTINCT name FROM bookmarks WHERE id >= ?''',
+        'file_metadata_insert': '''INSERT OR IGNORE INTO file_metadata (name) SELECT DISTINCT name FROM bookmarks WHERE id >= ?''',
+    }
+
+    def __init__(self, path=None):
+        if path is None:
+            path = expanduser(DATABASE_PATH)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=self.busy_timeout)
+        #self.conn = sqlite3.connect(expanduser('/mnt/nas2/morpheus_20201109/home/Radio_X/mocp-bookmarks.sqlite'))
+        self.conn.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+        if self.journal_mode == 'WAL':
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+        self.listeners = []
+        self.batch_depth = 0
+        self.pending_changes = []
+        self.data_version = self.get_data_version()
+
+    def listen(self, handler):
+        """Call handler(change, row, old_row) after every change of a bookmark.
+
+        change is 'add', 'update' or 'delete'. row is the bookmark as
+        stored, or as it was before deletion. old_row is the bookmark
+        before an update, None for the other changes. 'reload', with both
+        rows None, means anything may have changed.
+        """
+        self.listeners.append(handler)
+
+    def unlisten(self, handler):
+        self.listeners.remove(handler)
+
+    def notify(self, change, row=None, old_row=None):
+        if self.batch_depth > 0:
+            self.pending_changes.append((change, row, old_row))
+            return
+        for handler in self.listeners:
+            handler(change, row, old_row)
+
+    def commit(self):
+        if self.batch_depth == 0:
+            self.conn.commit()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group writes into one transaction.
+
+        Nested batches join the outermost one. It commits when that ends
+        and only then are the listeners told about the changes; on an
+        exception everything is rolled back and nobody is notified.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        except:
+            self.batch_depth -= 1
+            if self.batch_depth == 0:
+                self.conn.rollback()
+                self.pending_changes = []
+            raise
+        self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.conn.commit()
+            changes, self.pending_changes = self.pending_changes, []
+            for change in changes:
+                self.notify(*change)
+
+    def get_data_version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    @timed('db')
+    def check_for_changes(self):
+        """Notify a 'reload' if another connection committed since the last check.
+
+        PRAGMA data_version only changes with commits of other connections,
+        so this is cheap enough to call every few seconds.
+        """
+        version = self.get_data_version()
+        if version == self.data_version:
+            return False
+        self.data_version = version
+        self.notify('reload')
+        return True
+
+    def get_schema_version(self):
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        row = cursor.execute("SELECT version FROM schema_version").fetchone()
+        cursor.close()
+        return 0 if row is None else row[0]
+
+    def migrate(self):
+        """Bring the schema up to date, every migration in its own transaction."""
+        version = self.get_schema_version()
+        for migration in self.migrations[version:]:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN")
+            try:
+                for statement in migration:
+                    cursor.execute(statement)
+                cursor.execute("DELETE FROM schema_version")
+                cursor.execute("INSERT INTO schema_version (version) VALUES (?)", (version + 1,))
+            except:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+            cursor.close()
+            version += 1
+
+    @timed('db')
+    def add(self, filename, position, rating=None, comment=""):
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT INTO bookmarks (datetime_created, name, rating, position, comment) VALUES (datetime('now'), ?, ?, ?, ?)",
+                (filename, rating, position, comment))
+        row = (cursor.lastrowid, filename, rating, position, comment)
+        cursor.close()
+        self.commit()
+        self.notify('add', row)
+        return row
+
+    @timed('db')
+    def delete(self, bookmark_id):
+        row = self.get_bookmark(bookmark_id)
+        if row is None:
+            return None
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM bookmarks WHERE id=?", (bookmark_id,))
+        cursor.close()
+        self.commit()
+        self.notify('delete', row)
+        return row
+
+    @timed('db')
+    def update(self, bookmark_id, rating=None, comment=None):
+        old_row = self.get_bookmark(bookmark_id)
+        if old_row is None:
+            return None
+        cursor = self.conn.cursor()
+        cursor.execute("UPDATE bookmarks SET rating=?, comment=? WHERE id=?", (rating, comment, bookmark_id))
+        cursor.close()
+        self.commit()
+        row = (old_row[0], old_row[1], rating, old_row[3], comment)
+        self.notify('update', row, old_row)
+        return row
+
+    @timed('db')
+    def get_bookmark(self, bookmark_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE id=?", (bookmark_id,))
+        return cursor.fetchone()
+
+    @timed('db')
+    def matches(self, bookmark_id, where, params=()):
+        """Tell whether the bookmark satisfies the SQL condition where."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT 1 FROM bookmarks WHERE id=? AND (%s)" % where, (bookmark_id,) + tuple(params))
+        return cursor.fetchone() is not None
+
+    @timed('db')
+    def search_matches(self, search_string, bookmark_id):
+        match = self.make_match_expression(search_string)
+        if match == '':
+            return True
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT 1 FROM bookmarks_fts WHERE bookmarks_fts MATCH ? AND rowid=?", (match, bookmark_id))
+        return cursor.fetchone() is not None
+
+    @timed('db')
+    def get_all(self):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks ORDER BY id ASC, position ASC")
+        return cursor.fetchall()
+
+    def get_filtered(self, filter_string):
+        return self.search(filter_string)
+
+    def make_match_expression(self, search_string):
+        """Turn user input into an FTS5 query matching all words as
+        prefixes, see compile_query()."""
+        return compile_query(search_string.strip()).match
+
+    @timed('db')
+    def search(self, search_string, limit=None):
+        """Return the limit best matching bookmarks for search_string, best first."""
+        match = self.make_match_expression(search_string)
+        if match == '':
+            return self.get_all()
+        if limit is None:
+            limit = self.search_limit
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT b.id, b.name, b.rating, b.position, b.comment FROM (SELECT rowid, bm25(bookmarks_fts, ?, ?, ?) AS score FROM bookmarks_fts WHERE bookmarks_fts MATCH ? ORDER BY score, rowid LIMIT ?) f JOIN bookmarks b ON b.id = f.rowid ORDER BY f.score, b.id",
+                self.search_weights + (match, limit))
+        return cursor.fetchall()
+
+    @timed('db')
+    def count_bookmarks(self, where, params=(), limit=-1):
+        """Count the bookmarks satisfying the SQL condition where, up to limit."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT count(*) FROM (SELECT 1 FROM bookmarks WHERE %s LIMIT ?)" % where,
+                tuple(params) + (limit,))
+        return cursor.fetchone()[0]
+
+    @timed('db')
+    def count_matches(self, search_string, limit=-1):
+        """Count the bookmarks matching search_string, up to limit."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT count(*) FROM (SELECT 1 FROM bookmarks_fts WHERE bookmarks_fts MATCH ? LIMIT ?)",
+                (self.make_match_expression(search_string), limit))
+        return cursor.fetchone()[0]
+
+    @timed('db')
+    def search_ids(self, search_string):
+        """Return the ids of all bookmarks matching search_string, best first."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT rowid FROM bookmarks_fts WHERE bookmarks_fts MATCH ? ORDER BY bm25(bookmarks_fts, ?, ?, ?), rowid",
+                (self.make_match_expression(search_string),) + self.search_weights)
+        return [row[0] for row in cursor]
+
+    @timed('db')
+    def get_match_page(self, search_string, key=None, direction='after', limit=100):
+        """Return one page of the bookmarks matching search_string in id
+        order, like get_page() with the key (id,). The ids come from the
+        full text index, which pages through its matches by rowid
+        without reading the others."""
+        sql = "SELECT rowid FROM bookmarks_fts WHERE bookmarks_fts MATCH ?"
+        args = [self.make_match_expression(search_string)]
+        if key is not None:
+            sql += " AND rowid %s ?" % { 'after': '>', 'from': '>=', 'before': '<' }[direction]
+            args.append(key[0])
+        sql += " ORDER BY rowid %s LIMIT ?" % ('DESC' if direction == 'before' else 'ASC')
+        args.append(limit)
+        cursor = self.conn.cursor()
+        cursor.execute(sql, args)
+        ids = [row[0] for row in cursor]
+        if direction == 'before':
+            ids.reverse()
+        return self.get_bookmarks(ids)
+
+    @timed('db')
+    def get_bookmarks(self, ids):
+        """Return the bookmarks with the ids, in their order, skipping deleted ones."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE id IN (%s)" % ', '.join('?' * len(ids)),
+                tuple(ids))
+        rows = { row[0]: row for row in cursor }
+        return [rows[i] for i in ids if i in rows]
+
+    @timed('db')
+    def get_page(self, order_columns, key=None, direction='after', limit=100, where=None, params=(), sort=False):
+        """Return one page of bookmarks in the order of order_columns.
+
+        Keyset pagination: the page starts right after, at or right before
+        key, a tuple of order column values. Pages before a key are
+        returned in ascending order too. where is an optional SQL
+        condition with its params. sort keeps the order columns from
+        being looked up in an index, so that the rows are found through
+        an index on where and sorted, for a where few rows satisfy.
+        """
+        if sort:
+            order_columns = ['+' + c for c in order_columns]
+        clauses = []
+        args = list(params) if where else []
+        if where:
+            clauses.append('(%s)' % where)
+        if key is not None:
+            operator = { 'after': '>', 'from': '>=', 'before': '<' }[direction]
+            clauses.append('(%s) %s (%s)' % (', '.join(order_columns), operator,
+                    ', '.join('?' * len(key))))
+            args.extend(key)
+        sort = 'DESC' if direction == 'before' else 'ASC'
+        sql = "SELECT id, name, rating, position, comment FROM bookmarks"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY %s LIMIT ?" % ', '.join('%s %s' % (c, sort) for c in order_columns)
+        args.append(limit)
+        cursor = self.conn.cursor()
+        cursor.execute(sql, args)
+        rows = cursor.fetchall()
+        if direction == 'before':
+            rows.reverse()
+        return rows
+
+    @timed('db')
+    def get_next_bookmark(self, filename, position):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE name=? AND position > ? ORDER BY position ASC LIMIT 1",
+                (filename, position))
+        return cursor.fetchone()
+
+    @timed('db')
+    def get_previous_bookmark(self, filename, position, zapping_tolerance=ZAPPING_TOLERANCE):
+        cursor = self.conn.cursor()
+        position = int(position) - zapping_tolerance
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE name=? AND position < ? ORDER BY position DESC LIMIT 1",
+                (filename, position))
+        return cursor.fetchone()
+
+    @timed('db')
+    def get_bookmarks_by_file(self, filepath):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE name=? ORDER BY position ASC, id ASC", (filepath,))
+        return cursor.fetchall()
+
+    @timed('db')
+    def get_bookmarks_by_rating(self, rating, comparisonOperator=">=", filepath=None):
+        if comparisonOperator not in self.comparison_operators:
+            raise ValueError("invalid comparison operator: %r" % comparisonOperator)
+        cursor = self.conn.cursor()
+        if filepath is None:
+            cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE rating%s? ORDER BY name ASC, position ASC" % comparisonOperator,
+                    (rating,))
+        else:
+            cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE name=? AND rating%s? ORDER BY position ASC" % comparisonOperator,
+                    (filepath, rating))
+        return cursor.fetchall()
+
+    @timed('db')
+    def get_bookmarks_by_comment(self, search_string):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE comment LIKE ? ORDER BY name ASC, position ASC",
+                ('%%%s%%' % search_string,))
+        return cursor.fetchall()
+
+    def iter_bookmarks(self):
+        """Yield every bookmark as (name, position, rating, comment, created),
+        read lazily from the cursor."""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT name, position, rating, comment, datetime_created FROM bookmarks ORDER BY id ASC")
+        return cursor
+
+    @timed('db')
+    def import_bookmarks(self, bookmarks):
+        """Add (name, position, rating, comment, created) tuples in one transaction.
+
+        Bookmarks at the position of an existing one in the same file,
+        including one added earlier in the same import, are skipped. The
+        iterable is consumed lazily, so a generator over a large file is
+        imported without holding it in memory. On an error nothing is
+        added. Returns an ImportResult.
+        """
+        read = 0
+        def counted():
+            nonlocal read
+            for bookmark in bookmarks:
+                read += 1
+                yield bookmark
+        with self.batch():
+            cursor = self.conn.cursor()
+            if not self.conn.in_transaction:
+                cursor.execute("BEGIN")
+            first_id = cursor.execute("SELECT coalesce(max(id), 0) + 1 FROM bookmarks").fetchone()[0]
+            triggers = []
+            for name in self.bulk_insert_statements:
+                triggers.append(cursor.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()[0])
+                cursor.execute("DROP TRIGGER %s" % name)
+            cursor.executemany("INSERT INTO bookmarks (name, position, rating, comment, datetime_created) SELECT ?1, ?2, ?3, coalesce(?4, ''), coalesce(?5, datetime('now')) WHERE NOT EXISTS (SELECT 1 FROM bookmarks WHERE name=?1 AND position=?2)",
+                    counted())
+            added = cursor.rowcount
+            for statement in self.bulk_insert_statements.values():
+                cursor.execute(statement, (first_id,))
+            for trigger in triggers:
+                cursor.execute(trigger)
+            cursor.close()
+            if added > 0:
+                self.notify('reload')
+        return ImportResult(read, added)
+
+    def close(self):
+        self.conn.close()
+
+class KeysetBookmarkSource:
+    """Bookmarks in a fixed order, read page by page with keyset pagination.
+
+    A row's key is the tuple of its order column values, order_columns
+    must end with id to make keys unique. sort is passed on to
+    BookmarkDatabase.get_page().
+    """
+
+    row_columns = { 'id': 0, 'name': 1, 'rating': 2, 'position': 3, 'comment': 4 }
+
+    def __init__(self, db, order_columns=('id',), where=None, params=(), sort=False):
+        self.db = db
+        self.order_columns = tuple(order_columns)
+        self.indexes = [self.row_columns[c] for c in self.order_columns]
+        self.where = where
+        self.params = params
+        self.sort = sort
+
+    def key(self, row):
+        return tuple(row[i] for i in self.indexes)
+
+    def rows(self, key=None, direction='after', limit=100):
+        return self.db.get_page(self.order_columns, key, direction, limit,
+                self.where, self.params, self.sort)
+
+    def find(self, row):
+        return self.key(row)
+
+    def accept(self, row):
+        """Key of a new or changed row, None if it doesn't belong here."""
+        if self.where is not None and not self.db.matches(row[0], self.where, self.params):
+            return None
+        return self.key(row)
+
+    def discard(self, row):
+        pass
+
+    def iter_rows(self, page_size=1000):
+        key = None
+        while True:
+            rows = self.rows(key, 'after', page_size)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            key = self.key(rows[-1])
+
+class RankedBookmarkSource:
+    """Search results in rank order, keyed by their rank.
+
+    The ids of all matches are ranked once, at most
+    BookmarkDatabase.search_rank_limit of them, see bookmark_source(),
+    and the bookmarks are read a page of ids at a time. Bookmarks added
+    later which match the search are ranked last.
+    """
+
+    def __init__(self, db, search_string):
+        self.db = db
+        self.search_string = search_string
+        self.ids = db.search_ids(search_string)
+        self.rank_keys = list(range(len(self.ids)))
+        self.ranks = { bookmark_id: i for i, bookmark_id in enumerate(self.ids) }
+
+    def key(self, row):
+        return (self.ranks[row[0]],)
+
+    def rows(self, key=None, direction='after', limit=100):
+        if key is None:
+            if direction == 'before':
+                return self.db.get_bookmarks(self.ids[-limit:])
+            return self.db.get_bookmarks(self.ids[:limit])
+        if direction == 'before':
+            i = bisect.bisect_left(self.rank_keys, key[0])
+            return self.db.get_bookmarks(self.ids[max(0, i - limit):i])
+        if direction == 'after':
+            i = bisect.bisect_right(self.rank_keys, key[0])
+        else:
+            i = bisect.bisect_left(self.rank_keys, key[0])
+        return self.db.get_bookmarks(self.ids[i:i + limit])
+
+    def iter_rows(self, page_size=1000):
+        ids = list(self.ids)
+        for i in range(0, len(ids), page_size):
+            yield from self.db.get_bookmarks(ids[i:i + page_size])
+
+    def find(self, row):
+        rank = self.ranks.get(row[0])
+        return None if rank is None else (rank,)
+
+    def accept(self, row):
+        rank = self.ranks.get(row[0])
+        if rank is not None:
+            return (rank,)
+        if not self.db.search_matches(self.search_string, row[0]):
+            return None
+        rank = self.rank_keys[-1] + 1 if self.rank_keys else 0
+        self.ids.append(row[0])
+        self.rank_keys.append(rank)
+        self.ranks[row[0]] = rank
+        return (rank,)
+
+    def discard(self, row):
+        rank = self.ranks.pop(row[0], None)
+        if rank is not None:
+            i = bisect.bisect_left(self.rank_keys, rank)
+            del self.rank_keys[i]
+            del self.ids[i]
+
+CompiledQuery = collections.namedtuple('CompiledQuery',
+        ['where', 'params', 'match', 'ranked', 'filter', 'filter_params', 'ordered'])
+
+# a search term: a word or a "quoted phrase", optionally after a field
+# name and an operator. Patterns are kept as strings for re's cache to
+# compile when first used: re is imported by the code that uses them,
+# hotkey commands never load it
+QUERY_TERM_PATTERN = r'(?:([A-Za-z]+)(>=|<=|!=|=|<|>|:))?("[^"]*"?|[^\s"]*)'
+QUERY_OPERATORS = { ':': '=', '=': '=', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=' }
+# fields compared with bookmark columns, and fields searching columns
+# of the full text index
+QUERY_NUMBER_FIELDS = { 'rating': 'rating', 'pos': 'position', 'position': 'position' }
+QUERY_TEXT_FIELDS = { 'file': '{basename directory}', 'dir': 'directory', 'comment': 'comment' }
+
+def parse_duration(text):
+    """Seconds of '90', '45s', '5m', '1h30m', '1:30' or '1:02:03'."""
+    import re
+    if ':' in text:
+        parts = text.split(':')
+        if len(parts) <= 3 and all(part.isdigit() for part in parts):
+            return functools.reduce(lambda seconds, part: seconds * 60 + int(part), parts, 0)
+    else:
+        match = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?', text)
+        if match and text:
+            hours, minutes, seconds = (int(group or 0) for group in match.groups())
+            return hours * 3600 + minutes * 60 + seconds
+    raise ValueError("not a position: %r" % text)
+
+def match_term(value):
+    """FTS5 query matching value as a phrase, the last word as a prefix."""
+    return '"%s"*' % value.replace('"', '""')
+
+@functools.lru_cache(maxsize=256)
+def compile_query(search_string):
+    """Compile a search into a CompiledQuery: an SQL condition on the
+    bookmarks table with its params.
+
+    Words and "quoted phrases" match file names and comments, as
+    prefixes. Fields restrict further, all terms have to match:
+
+        rating>=4 rating:none file:RuFFM dir:Radio_X comment:"vocal" pos>1h pos<=1:30:00
+
+    The words and text fields become one query of the full text index,
+    rating and pos compare with their columns; operators come from a
+    fixed table and values are only ever bound as params. Results are
+    listed in id order: an equal rating or position seeks the (rating,
+    id) or (position, id) index, which lists them in that order, and
+    ordered is true. Other rating and pos comparisons are ranges of
+    these indexes, which aren't in id order, see bookmark_source().
+
+    match is the full text query of the words and text fields, and
+    ranked is true when that is all the query has, so its results can
+    be ranked. filter is the condition of the rating and pos fields
+    alone, None without them, with its filter_params: a single bookmark
+    is checked faster by these and match looked up for its rowid than
+    by where, which lists all matches of the full text query.
+
+    Other words followed by a colon are searched for as they are.
+    Raises ValueError for a field without a valid value. Compiled
+    queries are cached, searching as you type compiles each prefix only
+    once.
+    """
+    import re
+    conditions = []
+    params = []
+    terms = []
+    ordered = False
+    for m in re.finditer(QUERY_TERM_PATTERN, search_string):
+        field, operator, value = m.groups()
+        field = field.lower() if field else None
+        if field not in QUERY_NUMBER_FIELDS and field not in QUERY_TEXT_FIELDS:
+            field, value = None, m.group(0)
+        if value.startswith('"'):
+            value = value.strip('"')
+        elif field is None:
+            value = value.replace('"', '')
+        if field is not None and value == '':
+            raise ValueError("%s%s needs a value" % (field, operator))
+        if field is None:
+            if value.strip() != '':
+                terms.append(match_term(value.strip()))
+        elif field in QUERY_TEXT_FIELDS:
+            if operator not in (':', '='):
+                raise ValueError("%s can only be searched with %s:" % (field, field))
+            terms.append('%s : %s' % (QUERY_TEXT_FIELDS[field], match_term(value)))
+        elif field == 'rating' and value.lower() == 'none':
+            if operator not in (':', '=', '!='):
+                raise ValueError("rating:none can't be compared with %s" % operator)
+            conditions.append('rating IS %sNULL' % ('NOT ' if operator == '!=' else ''))
+            ordered = ordered or operator != '!='
+        else:
+            try:
+                number = int(value) if field == 'rating' else parse_duration(value)
+            except ValueError:
+                raise ValueError("%s%s needs a %s, not %r" % (field, operator,
+                        'number' if field == 'rating' else 'position like 90, 5m, 1h30m or 1:30:00', value))
+            conditions.append('%s %s ?' % (QUERY_NUMBER_FIELDS[field], QUERY_OPERATORS[operator]))
+            params.append(number)
+            ordered = ordered or QUERY_OPERATORS[operator] == '='
+    match = ' '.join(terms)
+    ranked = not conditions
+    filter = ' AND '.join(conditions) or None
+    filter_params = tuple(params)
+    if match != '':
+        conditions.insert(0, 'id IN (SELECT rowid FROM bookmarks_fts WHERE bookmarks_fts MATCH ?)')
+        params.insert(0, match)
+    return CompiledQuery(' AND '.join(conditions) or None, tuple(params), match, ranked,
+            filter, filter_params, ordered)
+
+def bookmark_source(db, search_string=None, order_columns=('id',)):
+    """Source of the bookmarks search_string finds: all in order_columns
+    order without a search, the best matches first for full text only
+    searches with up to BookmarkDatabase.search_rank_limit matches and
+    in id order for those with more, otherwise those matching in
+    order_columns order, read a page at a time. Pages of rating and pos
+    searches with up to BookmarkDatabase.filter_sort_limit matches are
+    found through an index and sorted, unless an equal value seeks them
+    in order already; scanning in order for a page of rare matches
+    takes up to 0.1s at 1M bookmarks."""
+    query = compile_query((search_string or '').strip())
+    if query.where is None:
+        return KeysetBookmarkSource(db, order_columns)
+    if query.ranked:
+        if db.count_matches(search_string, db.search_rank_limit + 1) <= db.search_rank_limit:
+            return RankedBookmarkSource(db, search_string)
+        return MatchBookmarkSource(db, search_string)
+    sort = (query.match == '' and not query.ordered
+            and db.count_bookmarks(query.where, query.params, db.filter_sort_limit + 1) <= db.filter_sort_limit)
+    return KeysetBookmarkSource(db, order_columns, query.where, query.params, sort)
+
+class MatchBookmarkSource(KeysetBookmarkSource):
+    """Bookmarks matching a full text search in id order, for searches
+    with too many matches to rank, read a page at a time."""
+
+    def __init__(self, db, search_string):
+        KeysetBookmarkSource.__init__(self, db)
+        self.search_string = search_string
+
+    def rows(self, key=None, direction='after', limit=100):
+        return self.db.get_match_page(self.search_string, key, direction, limit)
+
+    def accept(self, row):
+        if not self.db.search_matches(self.search_string, row[0]):
+            return None
+        return self.key(row)
+
+FileNode = collections.namedtuple('FileNode',
+        ['name', 'count', 'average_rating', 'max_rating', 'last_added'])
+
+class FileTreeSource:
+    """Bookmarks grouped by file: a FileNode per file with the aggregates
+    of its bookmarks, followed by the bookmarks if the file is in
+    expanded.
+
+    File nodes are keyed (name,) and bookmarks (name, position, id), so
+    a bookmark sorts after its file and before the next one. Files are
+    read a page at a time with a GROUP BY query over a range of names,
+    which the name index serves without touching other files, and a
+    file's bookmarks only when it is expanded. search_string restricts
+    both to the matching bookmarks.
+    """
+
+    page_size = 100
+
+    def __init__(self, db, search_string=None, expanded=None):
+        self.db = db
+        self.search_string = (search_string or '').strip() or None
+        self.expanded = expanded if expanded is not None else set()
+        self.where = '1'
+        self.params = ()
+        if self.search_string is not None:
+            query = compile_query(self.search_string)
+            if query.where is not None:
+                self.where = query.where
+                self.params = query.params
+
+    def key(self, row):
+        if isinstance(row, FileNode):
+            return (row.name,)
+        return (row[1], row[3], row[0])
+
+    @timed('db', 'file groups')
+    def groups(self, condition, params, descending=False, limit=None):
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT name, count(*), avg(rating), max(rating), max(datetime_created) FROM bookmarks WHERE %s AND (%s) GROUP BY name ORDER BY name %s LIMIT ?"
+                % (condition, self.where, 'DESC' if descending else 'ASC'),
+                tuple(params) + self.params + (limit or self.page_size,))
+        return [FileNode(*row) for row in cursor]
+
+    def children(self, name):
+        if name not in self.expanded:
+            return []
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT id, name, rating, position, comment FROM bookmarks WHERE name=? AND (%s) ORDER BY position, id" % self.where,
+                (name,) + self.params)
+        return cursor.fetchall()
+
+    def forward(self, key, inclusive):
+        """Yield the rows after key, or from key if inclusive, in key order."""
+        after = None
+        if key is not None:
+            after = key[0]
+            if len(key) == 1 and inclusive:
+                yield from self.groups("name = ?", (after,))
+            for row in self.children(after):
+                if len(key) == 1 or (row[3], row[0]) > key[1:] or \
+                        (inclusive and (row[3], row[0]) == key[1:]):
+                    yield row
+        while True:
+            if after is None:
+                nodes = self.groups("1", ())
+            else:
+                nodes = self.groups("name > ?", (after,))
+            for node in nodes:
+                yield node
+                yield from self.children(node.name)
+            if len(nodes) < self.page_size:
+                return
+            after = nodes[-1].name
+
+    def backward(self, key):
+        """Yield the rows before key in descending key order."""
+        before = None
+        if key is not None:
+            before = key[0]
+            if len(key) > 1:
+                for row in reversed(self.children(before)):
+                    if (row[3], row[0]) < key[1:]:
+                        yield row
+                yield from self.groups("name = ?", (before,))
+        while True:
+            if before is None:
+                nodes = self.groups("1", (), descending=True)
+            else:
+                nodes = self.groups("name < ?", (before,), descending=True)
+            for node in nodes:
+                yield from reversed(self.children(node.name))
+                yield node
+            if len(nodes) < self.page_size:
+                return
+            before = nodes[-1].name
+
+    def rows(self, key=None, direction='after', limit=100):
+        if direction == 'before':
+            rows = list(itertools.islice(self.backward(key), limit))
+            rows.reverse()
+            return rows
+        return list(itertools.islice(self.forward(key, direction == 'from'), limit))
+
+    def iter_rows(self, page_size=1000):
+        return self.forward(None, False)
+
+    def find(self, row):
+        return self.key(row)
+
+    def accept(self, row):
+        """Changes alter the file's aggregates too, the view is reloaded instead."""
+        return None
+
+    def discard(self, row):
+        pass
+
+def cue_format_seconds(seconds):
+    s = seconds % 60
+    m = seconds / 60
+    return "%02d:%02d:00" % (m, s)
+
+def format_seconds(seconds):
+    s = seconds % 60
+    m = seconds / 60 % 60
+    h = seconds / 60 / 60
+    return "%02dh:%02dm:%02ds" % (h, m, s)
+
+CueExportResult = collections.namedtuple('CueExportResult', ['written', 'removed', 'failed'])
+
+class CueExporter:
+    """Writes a cue sheet next to every bookmarked file.
+
+    Triggers record the files whose bookmarks changed in cue_dirty, and
+    by default only those sheets are rewritten. The bookmarks are read
+    with one query ordered by file and position and written file by
+    file, each sheet to a temporary file renamed over the old one.
+    """
+
+    generator = 'REM GENERATOR "mocp-bookmark-manager"'
+
+    def __init__(self, db):
+        self.db = db
+
+    def iter_files(self, everything=False):
+        """Yield (file name, bookmark rows) per file, files without bookmarks
+        left have no rows. everything yields all bookmarked files and the
+        changed ones without bookmarks left."""
+        cursor = self.db.conn.cursor()
+        if everything:
+            cursor.execute("SELECT name, id, name, rating, position, comment FROM bookmarks UNION ALL SELECT d.name, NULL, NULL, NULL, NULL, NULL FROM cue_dirty d WHERE NOT EXISTS (SELECT 1 FROM bookmarks b WHERE b.name = d.name) ORDER BY 1, 5")
+        else:
+            cursor.execute("SELECT d.name, b.id, b.name, b.rating, b.position, b.comment FROM cue_dirty d LEFT JOIN bookmarks b ON b.name = d.name ORDER BY d.name, b.position")
+        for name, rows in itertools.groupby(cursor, key=lambda row: row[0]):
+            yield name, [row[1:] for row in rows if row[1] is not None]
+
+    def format(self, filename, rows):
+        lines = [self.generator, 'FILE "%s" MP3' % os.path.basename(filename)]
+        for track_id, row in enumerate(rows, 1):
+            lines.append('  TRACK %02d AUDIO' % track_id)
+            lines.append('    INDEX 01 %s' % cue_format_seconds(row[3]))
+            lines.append('    TITLE "%s"' % format_seconds(row[3]))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, rows):
+        path = '%s.cue' % filename
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wt') as cuefile:
+            cuefile.write(self.format(filename, rows))
+        os.replace(tmp_path, path)
+
+    def remove(self, filename):
+        """Delete the cue sheet of a file without bookmarks, if we wrote it."""
+        path = '%s.cue' % filename
+        try:
+            with open(path, 'rt') as cuefile:
+                if cuefile.readline().rstrip('\n') != self.generator:
+                    return False
+        except FileNotFoundError:
+            return False
+        os.unlink(path)
+        return True
+
+    def export(self, everything=False):
+        written = removed = 0
+        failed = []
+        done = []
+        for filename, rows in self.iter_files(everything):
+            try:
+                if rows:
+                    self.write(filename, rows)
+                    written += 1
+                elif self.remove(filename):
+                    removed += 1
+                done.append((filename,))
+            except OSError as e:
+                failed.append((filename, str(e)))
+        with self.db.batch():
+            self.db.conn.executemany("DELETE FROM cue_dirty WHERE name=?", done)
+        return CueExportResult(written, removed, failed)
+
+def export_cue_sheets(database_path=None, everything=False):
+    """Export cue sheets on a connection of its own, e.g. from a thread."""
+    db = BookmarkDatabase(database_path)
+    try:
+        return CueExporter(db).export(everything)
+    finally:
+        db.close()
+
+ImportResult = collections.namedtuple('ImportResult', ['read', 'added'])
+
+# fields of the JSONL and CSV formats, in the order of iter_bookmarks()
+BOOKMARK_FIELDS = ('name', 'position', 'rating', 'comment', 'created')
+BOOKMARK_FORMATS = { '.jsonl': 'jsonl', '.json': 'jsonl', '.csv': 'csv', '.cue': 'cue' }
+
+def bookmark_from_record(record, where):
+    """Turn a dict read from a JSONL or CSV file into an import tuple."""
+    try:
+        name = record['name']
+        position = int(record['position'])
+        rating = record.get('rating')
+        rating = None if rating in (None, '') else int(rating)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("%s: a bookmark needs a name, a position in seconds and an optional numeric rating" % where)
+    if not name:
+        raise ValueError("%s: a bookmark needs a name" % where)
+    return (name, position, rating, record.get('comment') or '', record.get('created') or None)
+
+def read_bookmarks_jsonl(lines, source='<jsonl>'):
+    import json
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        where = '%s:%d' % (source, line_number)
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError("%s: %s" % (where, e))
+        if not isinstance(record, dict):
+            raise ValueError("%s: expected an object" % where)
+        yield bookmark_from_record(record, where)
+
+def read_bookmarks_csv(lines, source='<csv>'):
+    import csv
+    reader = csv.DictReader(lines)
+    for record in reader:
+        yield bookmark_from_record(record, '%s:%d' % (source, reader.line_num))
+
+def cue_parse_index(value):
+    """Seconds of a cue sheet time, mm:ss:ff with 75 frames per second."""
+    minutes, seconds, frames = value.split(':')
+    return int(minutes) * 60 + int(seconds)
+
+def read_cue_sheet(path):
+    """Yield a bookmark for the INDEX 01 of every track in a cue sheet.
+
+    FILE names are relative to the directory of the sheet. Track titles
+    become comments, except in sheets we generated, whose titles only
+    repeat the position.
+    """
+    import re
+    directory = os.path.dirname(os.path.abspath(path))
+    filename = None
+    generated = False
+    track = None
+    def bookmark(track):
+        if filename is None or track.get('position') is None:
+            return None
+        comment = '' if generated else track.get('title', '')
+        return (filename, track['position'], None, comment, None)
+    with open(path, 'rt', encoding='utf-8-sig', errors='replace') as cuefile:
+        for line_number, line in enumerate(cuefile, 1):
+            line = line.strip()
+            if line_number == 1 and line == CueExporter.generator:
+                generated = True
+            keyword, _, value = line.partition(' ')
+            keyword = keyword.upper()
+            value = value.strip()
+            if keyword in ('FILE', 'TRACK') and track is not None:
+                b = bookmark(track)
+                if b is not None:
+                    yield b
+                track = None
+            if keyword == 'FILE':
+                match = re.match(r'^"(.*)"(\s+\S+)?$|^(\S+)', value)
+                filename = os.path.join(directory, match.group(1) if match.group(1) is not None else match.group(3))
+            elif keyword == 'TRACK':
+                track = {}
+            elif track is not None and keyword == 'TITLE':
+                track['title'] = value[1:-1] if value.startswith('"') and value.endswith('"') else value
+            elif track is not None and keyword == 'INDEX':
+                number, _, time = value.partition(' ')
+                if number == '01':
+                    try:
+                        track['position'] = cue_parse_index(time.strip())
+                    except ValueError:
+                        raise ValueError("%s:%d: invalid index time %r" % (path, line_number, time))
+    if track is not None:
+        b = bookmark(track)
+        if b is not None:
+            yield b
+
+def find_cue_sheets(path):
+    """Yield path if it is a file, else the cue sheets below the directory."""
+    if not os.path.isdir(path):
+        yield path
+        return
+    for directory, subdirectories, files in os.walk(path):
+        subdirectories.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.cue'):
+                yield os.path.join(directory, name)
+
+def guess_bookmark_format(path):
+    if path == '-':
+        return 'jsonl'
+    if os.path.isdir(path):
+        return 'cue'
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in BOOKMARK_FORMATS:
+        raise ValueError("%s: unknown format, use --format" % path)
+    return BOOKMARK_FORMATS[extension]
+
+def read_bookmarks(path, format=None):
+    """Yield import tuples from a JSONL, CSV or cue file, '-' is stdin,
+    a directory is searched for cue sheets."""
+    if format is None:
+        format = guess_bookmark_format(path)
+    if format == 'cue':
+        for cue_path in find_cue_sheets(path):
+            yield from read_cue_sheet(cue_path)
+        return
+    read = read_bookmarks_csv if format == 'csv' else read_bookmarks_jsonl
+    if path == '-':
+        yield from read(sys.stdin, '<stdin>')
+        return
+    with open(path, 'rt', encoding='utf-8', newline='') as f:
+        yield from read(f, path)
+
+def write_bookmarks_jsonl(bookmarks, f):
+    import json
+    count = 0
+    for bookmark in bookmarks:
+        f.write(json.dumps(dict(zip(BOOKMARK_FIELDS, bookmark)), ensure_ascii=False))
+        f.write('\n')
+        count += 1
+    return count
+
+def write_bookmarks_csv(bookmarks, f):
+    import csv
+    writer = csv.writer(f)
+    writer.writerow(BOOKMARK_FIELDS)
+    count = 0
+    for bookmark in bookmarks:
+        writer.writerow(bookmark)
+        count += 1
+    return count
+
+# bytes hashed per sampled block, and blocks sampled per file
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+FINGERPRINT_BLOCKS = 16
+
+def file_fingerprint(path, size=None):
+    """Fingerprint of a file's content from its size and sampled blocks.
+
+    FINGERPRINT_BLOCKS blocks spread evenly from the start to the end of
+    the file are hashed, so at most a megabyte is read however large the
+    file is. Smaller files are hashed whole.
+    """
+    import hashlib
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        if size is None:
+            size = os.fstat(f.fileno()).st_size
+        digest.update(struct.pack('<Q', size))
+        if size <= FINGERPRINT_BLOCK_SIZE * FINGERPRINT_BLOCKS:
+            offsets = range(0, size, FINGERPRINT_BLOCK_SIZE)
+        else:
+            step = (size - FINGERPRINT_BLOCK_SIZE) / (FINGERPRINT_BLOCKS - 1)
+            offsets = [int(i * step) for i in range(FINGERPRINT_BLOCKS)]
+        for offset in offsets:
+            digest.update(os.pread(f.fileno(), FINGERPRINT_BLOCK_SIZE, offset))
+    return digest.digest()
+
+RelinkResult = collections.namedtuple('RelinkResult',
+        ['fingerprinted', 'missing', 'relinked', 'unknown', 'ambiguous', 'failed'])
+
+class FileRelinker:
+    """Finds bookmarked files again after they were moved or renamed.
+
+    update() stores the fingerprint of every bookmarked file that exists,
+    computing it again only when the file's size or modification time
+    changed. relink() walks directory trees for files of the size of a
+    missing one and moves the bookmarks of each missing file whose
+    fingerprint matches exactly one file found. Directories are scanned
+    and files fingerprinted by a pool of threads, as the time goes into
+    waiting for the disk or network share.
+    """
+
+    workers = 8
+
+    def __init__(self, db):
+        self.db = db
+
+    def fingerprints(self, files):
+        """Yield (path, size, mtime_ns, fingerprint) for (path, size, mtime_ns)
+        tuples, with the OSError instead of the fingerprint on failure."""
+        import concurrent.futures
+        def fingerprint(entry):
+            try:
+                return entry + (file_fingerprint(entry[0], entry[1]),)
+            except OSError as e:
+                return entry + (e,)
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            yield from executor.map(fingerprint, files)
+
+    def update(self):
+        """Fingerprint new and changed bookmarked files and forget those of
+        files without bookmarks. Returns (count fingerprinted, names of
+        missing files, (name, error) failures)."""
+        conn = self.db.conn
+        known = { name: (size, mtime_ns) for name, size, mtime_ns in
+                conn.execute("SELECT name, size, mtime_ns FROM file_fingerprints") }
+        missing = []
+        changed = []
+        for name, in conn.execute("SELECT DISTINCT name FROM bookmarks").fetchall():
+            try:
+                st = os.stat(name)
+            except OSError:
+                missing.append(name)
+                continue
+            if known.get(name) != (st.st_size, st.st_mtime_ns):
+                changed.append((name, st.st_size, st.st_mtime_ns))
+        fingerprints = []
+        failed = []
+        for name, size, mtime_ns, fingerprint in self.fingerprints(changed):
+            if isinstance(fingerprint, OSError):
+                failed.append((name, str(fingerprint)))
+            else:
+                fingerprints.append((name, size, mtime_ns, fingerprint))
+        with self.db.batch():
+            conn.executemany("INSERT OR REPLACE INTO file_fingerprints (name, size, mtime_ns, fingerprint) VALUES (?, ?, ?, ?)",
+                    fingerprints)
+            conn.execute("DELETE FROM file_fingerprints WHERE name NOT IN (SELECT name FROM bookmarks)")
+        return len(fingerprints), missing, failed
+
+    def scan(self, directories, sizes):
+        """Yield (path, size, mtime_ns) of the files under directories whose
+        size is in sizes. Only directory entries are read, no file content."""
+        import concurrent.futures
+        def scan_directory(path):
+            subdirectories = []
+            files = []
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirectories.append(entry.path)
+                            elif entry.is_file(follow_symlinks=False):
+                                st = entry.stat(follow_symlinks=False)
+                                if st.st_size in sizes:
+                                    files.append((os.path.abspath(entry.path), st.st_size, st.st_mtime_ns))
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+            return subdirectories, files
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = { executor.submit(scan_directory, path) for path in directories }
+            while pending:
+                done, pending = concurrent.futures.wait(pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    subdirectories, files = future.result()
+                    pending.update(executor.submit(scan_directory, path) for path in subdirectories)
+                    yield from files
+
+    def relink(self, directories=(), dry_run=False):
+        """Update the fingerprints, then move the bookmarks of missing files
+        to their matches under directories, in one transaction. Returns a
+        RelinkResult, relinked holds (old name, new name) pairs."""
+        fingerprinted, missing, failed = self.update()
+        conn = self.db.conn
+        lost = {}
+        unknown = []
+        for name in missing:
+            row = conn.execute("SELECT size, fingerprint FROM file_fingerprints WHERE name=?", (name,)).fetchone()
+            if row is None:
+                unknown.append(name)
+            else:
+                lost.setdefault(tuple(row), []).append(name)
+        found = {}
+        if lost and directories:
+            sizes = set(size for size, fingerprint in lost)
+            bookmarked = set(name for name, in conn.execute("SELECT DISTINCT name FROM bookmarks"))
+            candidates = [entry for entry in self.scan(directories, sizes) if entry[0] not in bookmarked]
+            for path, size, mtime_ns, fingerprint in self.fingerprints(candidates):
+                if isinstance(fingerprint, OSError):
+                    failed.append((path, str(fingerprint)))
+                elif (size, fingerprint) in lost:
+                    found.setdefault((size, fingerprint), []).append((path, mtime_ns))
+        relinked = []
+        ambiguous = []
+        for key, names in lost.items():
+            matches = found.get(key, [])
+            if len(names) == 1 and len(matches) == 1:
+                relinked.append((names[0], matches[0][0], matches[0][1], key))
+            elif matches:
+                ambiguous.append((names, [path for path, mtime_ns in matches]))
+        if relinked and not dry_run:
+            with self.db.batch():
+                for old_name, new_name, mtime_ns, (size, fingerprint) in relinked:
+                    conn.execute("UPDATE bookmarks SET name=? WHERE name=?", (new_name, old_name))
+                    conn.execute("UPDATE playback_history SET name=? WHERE name=?", (new_name, old_name))
+                    conn.execute("DELETE FROM file_fingerprints WHERE name=?", (old_name,))
+                    conn.execute("INSERT OR REPLACE INTO file_fingerprints (name, size, mtime_ns, fingerprint) VALUES (?, ?, ?, ?)",
+                            (new_name, size, mtime_ns, fingerprint))
+                self.db.notify('reload')
+        return RelinkResult(fingerprinted, len(missing), [(old_name, new_name) for old_name, new_name, mtime_ns, key in relinked],
+                unknown, ambiguous, failed)
+
+FileMetadata = collections.namedtuple('FileMetadata',
+        ['present', 'size', 'mtime_ns', 'duration', 'checked'])
+
+def file_duration(path):
+    """Duration in seconds from the file's header, None if unknown. WAV
+    files are read directly, other formats need ffprobe."""
+    if path.lower().endswith('.wav'):
+        import wave
+        try:
+            with wave.open(path, 'rb') as wav:
+                return wav.getnframes() / wav.getframerate()
+        except (OSError, EOFError, wave.Error, ZeroDivisionError):
+            return None
+    import shutil
+    import subprocess
+    ffprobe = shutil.which('ffprobe')
+    if ffprobe is None:
+        return None
+    try:
+        result = subprocess.run([ffprobe, '-v', 'error', '-show_entries', 'format=duration',
+                '-of', 'default=noprint_wrappers=1:nokey=1', path],
+                capture_output=True, text=True, timeout=30)
+        return float(result.stdout)
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+
+def check_files(files, slow_seconds=None):
+    """Stat (name, FileMetadata) files and return their (name, FileMetadata)
+    as they are now.
+
+    The duration is only read again for files whose size or modification
+    time changed. A missing file keeps what was known about it. If a
+    stat takes longer than slow_seconds the rest of the files are left
+    for later, so a caller can slow down on an overloaded mount.
+    """
+    results = []
+    for name, old in files:
+        started = time.monotonic()
+        try:
+            st = os.stat(name)
+        except OSError:
+            results.append((name, old._replace(present=False, checked=time.time())))
+        else:
+            duration = old.duration
+            if (st.st_size, st.st_mtime_ns) != (old.size, old.mtime_ns):
+                duration = file_duration(name) or duration
+            results.append((name, FileMetadata(True, st.st_size, st.st_mtime_ns, duration, time.time())))
+        if slow_seconds is not None and time.monotonic() - started > slow_seconds:
+            break
+    return results
+
+class FileMetadataStore:
+    """Existence, size, modification time and duration of bookmarked files.
+
+    Triggers add a file_metadata row for every bookmarked file. The rows
+    are held in memory for display, due() hands out those checked longest
+    ago, to be passed to check_files() off the UI thread, and store()
+    saves the results. Missing files are checked more often, to notice
+    a mount coming back.
+    """
+
+    recheck_seconds = 600
+    recheck_missing_seconds = 60
+
+    def __init__(self, db):
+        self.db = db
+        self.files = {}
+        self.load()
+
+    def load(self):
+        self.files = { row[0]: FileMetadata(*row[1:]) for row in self.db.conn.execute(
+                "SELECT name, present, size, mtime_ns, duration, checked FROM file_metadata") }
+
+    def get(self, name):
+        return self.files.get(name)
+
+    def due(self, limit, now=None):
+        """Up to limit (name, FileMetadata) of files due to be checked."""
+        if now is None:
+            now = time.time()
+        cursor = self.db.conn.execute("SELECT name, present, size, mtime_ns, duration, checked FROM file_metadata WHERE checked <= ? OR (present = 0 AND checked <= ?) ORDER BY checked LIMIT ?",
+                (now - self.recheck_seconds, now - self.recheck_missing_seconds, limit))
+        return [(row[0], FileMetadata(*row[1:])) for row in cursor]
+
+    def store(self, results):
+        """Save check_files() results, return the names of the files whose
+        presence or duration changed."""
+        changed = []
+        with self.db.batch():
+            self.db.conn.executemany("UPDATE file_metadata SET present=?, size=?, mtime_ns=?, duration=?, checked=? WHERE name=?",
+                    [tuple(metadata) + (name,) for name, metadata in results])
+        for name, metadata in results:
+            old = self.files.get(name)
+            if old is None or (old.present, old.duration) != (metadata.present, metadata.duration):
+                changed.append(name)
+            self.files[name] = metadata
+        return changed
+
+    def set_duration(self, name, duration):
+        """Store a duration reported by the player, return whether it changed."""
+        old = self.files.get(name)
+        if old is not None and old.duration is not None and abs(old.duration - duration) < 1:
+            return False
+        with self.db.batch():
+            self.db.conn.execute("UPDATE file_metadata SET duration=? WHERE name=?", (duration, name))
+        self.files[name] = (old or FileMetadata(None, None, None, None, 0))._replace(duration=duration)
+        return True
+
+class PeakSummary:
+    """Peak levels of a recording, 0 to 255 per seconds_per_peak, read
+    from a memory mapped cache file."""
+
+    def __init__(self, mapped, seconds_per_peak, count, offset):
+        self.mapped = mapped
+        self.seconds_per_peak = seconds_per_peak
+        self.count = count
+        self.offset = offset
+
+    @property
+    def duration(self):
+        return self.count * self.seconds_per_peak
+
+    def levels(self, columns, duration=None):
+        """Highest peak in each of columns equal slices of duration seconds,
+        None for slices past the summary's end."""
+        if duration is None:
+            duration = self.duration
+        levels = []
+        for column in range(columns):
+            start = int(column * duration / columns / self.seconds_per_peak)
+            end = max(start + 1, int((column + 1) * duration / columns / self.seconds_per_peak))
+            end = min(end, self.count)
+            if start >= end:
+                levels.append(None)
+            else:
+                levels.append(max(self.mapped[self.offset + start:self.offset + end]))
+        return levels
+
+    def close(self):
+        self.mapped.close()
+
+class PeakCache:
+    """Peak summaries of recordings, one file each under directory.
+
+    The cache file of a recording is named after a hash of its path, size
+    and modification time, so a changed recording gets a new summary.
+    Files hold a header and a byte per peak and are memory mapped for
+    reading; stale ones are never read again and can be deleted.
+    """
+
+    magic = b'MBMPEAK1'
+    header = struct.Struct('<8sdI')
+    seconds_per_peak = 1.0
+    default_directory = '~/.cache/mocp-bookmark-manager/peaks'
+
+    def __init__(self, directory=None):
+        self.directory = expanduser(directory or self.default_directory)
+
+    def path(self, filename):
+        """Path of the cache file for filename as it is now, None if it doesn't exist."""
+        import hashlib
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        key = '%s\0%d\0%d' % (filename, st.st_size, st.st_mtime_ns)
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest() + '.peaks')
+
+    def get(self, filename):
+        """Return the PeakSummary of filename, None if it isn't cached."""
+        path = self.path(filename)
+        if path is None:
+            return None
+        import mmap
+        try:
+            with open(path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        magic, seconds_per_peak, count = self.header.unpack_from(mapped) \
+                if len(mapped) >= self.header.size else (None, 0, 0)
+        if magic != self.magic or len(mapped) < self.header.size + count:
+            mapped.close()
+            return None
+        return PeakSummary(mapped, seconds_per_peak, count, self.header.size)
+
+    def put(self, filename, peaks, seconds_per_peak=None):
+        """Store peaks, bytes of levels 0 to 255, as the summary of filename."""
+        if seconds_per_peak is None:
+            seconds_per_peak = self.seconds_per_peak
+        path = self.path(filename)
+        if path is None:
+            raise FileNotFoundError("%s doesn't exist" % filename)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(self.header.pack(self.magic, seconds_per_peak, len(peaks)))
+            f.write(peaks)
+        os.replace(tmp_path, path)
+
+class FilePositionIndex:
+    """Bookmarks of each file sorted by position, for lookups without SQL.
+
+    A file's bookmarks are loaded the first time they are looked up and
+    then kept current through the database's change notifications.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        # file name -> (sorted positions, rows in the same order)
+        self.files = {}
+        db.listen(self.bookmark_changed)
+
+    def _entries(self, filename):
+        entries = self.files.get(filename)
+        if entries is None:
+            rows = self.db.get_bookmarks_by_file(filename)
+            entries = ([row[3] for row in rows], rows)
+            self.files[filename] = entries
+        return entries
+
+    def bookmark_changed(self, change, row, old_row):
+        if change == 'reload':
+            self.clear()
+            return
+        entries = self.files.get(row[1])
+        if entries is None:
+            return
+        positions, rows = entries
+        if change == 'add':
+            i = bisect.bisect_right(positions, row[3])
+            positions.insert(i, row[3])
+            rows.insert(i, row)
+            return
+        i = bisect.bisect_left(positions, row[3])
+        while i < len(rows) and rows[i][0] != row[0]:
+            i += 1
+        if i == len(rows):
+            return
+        if change == 'delete':
+            del positions[i]
+            del rows[i]
+        else:
+            rows[i] = row
+
+    def clear(self):
+        self.files.clear()
+
+    def get_bookmarks(self, filename):
+        return list(self._entries(filename)[1])
+
+    def get_positions(self, filename):
+        """Sorted positions of the file's bookmarks, not to be modified."""
+        return self._entries(filename)[0]
+
+    def next(self, filename, position):
+        positions, rows = self._entries(filename)
+        i = bisect.bisect_right(positions, position)
+        return rows[i] if i < len(rows) else None
+
+    def previous(self, filename, position, zapping_tolerance=ZAPPING_TOLERANCE):
+        positions, rows = self._entries(filename)
+        i = bisect.bisect_left(positions, position - zapping_tolerance)
+        return rows[i - 1] if i > 0 else None
+
+    def first(self, filename):
+        rows = self._entries(filename)[1]
+        return rows[0] if rows else None
+
+    def last(self, filename):
+        rows = self._entries(filename)[1]
+        return rows[-1] if rows else None
+
+    def nearest(self, filename, position):
+        positions, rows = self._entries(filename)
+        i = bisect.bisect_left(positions, position)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(rows)]
+        if not candidates:
+            return None
+        return rows[min(candidates, key=lambda j: abs(positions[j] - position))]
+
+# recording date and time in file names like 2021-06-26_18-55_-_RadioX_-_RuFFM.mp3
+RECORDING_DATE_PATTERN = r'(\d{4})[-_.](\d{2})[-_.](\d{2})(?:[_ T.-](\d{2})[-_.:h](\d{2}))?'
+
+def recording_date(filename):
+    """'YYYY-MM-DD HH:MM' from the file's name, the time 00:00 if it has
+    none, None without a date."""
+    import re
+    match = re.search(RECORDING_DATE_PATTERN, os.path.basename(filename))
+    if match is None:
+        return None
+    year, month, day, hour, minute = match.groups()
+    return '%s-%s-%s %s:%s' % (year, month, day, hour or '00', minute or '00')
+
+class FileIndex:
+    """The bookmarked files sorted in each of the orders, for jumping from
+    file to file.
+
+    The orders are 'path', 'date', the recording date in the name with
+    undated files last, and 'played', least recently played first. The
+    files are read from file_metadata, which has a row per bookmarked
+    file, at the first lookup and then kept current through the change
+    notifications. Each order is a sorted list of keys, so the file
+    before or after any file, bookmarked or not, is found by bisection.
+
+    A file reached by a jump in played order stays where it was in that
+    order until it is played otherwise, so repeated jumps walk through
+    the files instead of going back and forth between the last two
+    played. Jumps in played order wrap around at either end.
+    """
+
+    orders = ('path', 'date', 'played')
+
+    def __init__(self, db):
+        self.db = db
+        # file name -> unix time last played, 0 for never; None until loaded
+        self.played = None
+        # file name -> unix time its place in played order is from, for
+        # the files reached by jumps in played order
+        self.previous_played = {}
+        # order -> sorted keys, each ending with the file name
+        self.keys = {}
+        db.listen(self.bookmark_changed)
+
+    def load(self):
+        self.played = {}
+        self.previous_played = {}
+        for name, played, previous_played in self.db.conn.execute(
+                "SELECT name, played, previous_played FROM file_metadata"):
+            self.played[name] = played or 0
+            if previous_played is not None:
+                self.previous_played[name] = previous_played
+        self.keys = { order: sorted(self.key(order, name) for name in self.played)
+                for order in self.orders }
+
+    def key(self, order, name):
+        if order == 'path':
+            return (name,)
+        if order == 'date':
+            date = recording_date(name)
+            return (date is None, date or '', name)
+        if order == 'played':
+            return (self.previous_played.get(name, self.played.get(name, 0)), name)
+        raise ValueError("unknown file order: %r" % order)
+
+    def _insert(self, name):
+        for order, keys in self.keys.items():
+            bisect.insort(keys, self.key(order, name))
+
+    def _remove(self, name):
+        for order, keys in self.keys.items():
+            key = self.key(order, name)
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+
+    def add_file(self, name):
+        if name not in self.played:
+            self.played[name] = 0
+            self._insert(name)
+
+    def remove_file(self, name):
+        if name in self.played and self.db.conn.execute(
+                "SELECT 1 FROM bookmarks WHERE name=? LIMIT 1", (name,)).fetchone() is None:
+            self._remove(name)
+            del self.played[name]
+            self.previous_played.pop(name, None)
+
+    def bookmark_changed(self, change, row, old_row):
+        if self.played is None:
+            return
+        if change == 'reload':
+            self.played = None
+        elif change == 'add':
+            self.add_file(row[1])
+        elif change == 'delete':
+            self.remove_file(row[1])
+        elif change == 'update' and row[1] != old_row[1]:
+            self.add_file(row[1])
+            self.remove_file(old_row[1])
+
+    def files(self, order='path'):
+        if self.played is None:
+            self.load()
+        return [key[-1] for key in self.keys[order]]
+
+    def next(self, filename, order='path'):
+        """The file after filename, the first one if filename is None."""
+        if self.played is None:
+            self.load()
+        keys = self.keys[order]
+        i = 0 if filename is None else bisect.bisect_right(keys, self.key(order, filename))
+        if i == len(keys) and order == 'played':
+            i = 0
+        return keys[i][-1] if i < len(keys) and keys[i][-1] != filename else None
+
+    def previous(self, filename, order='path'):
+        """The file before filename, the last one if filename is None."""
+        if self.played is None:
+            self.load()
+        keys = self.keys[order]
+        i = len(keys) if filename is None else bisect.bisect_left(keys, self.key(order, filename))
+        if i == 0 and order == 'played':
+            i = len(keys)
+        return keys[i - 1][-1] if i > 0 and keys[i - 1][-1] != filename else None
+
+    def most_recent(self, exclude=None):
+        """The most recently played file other than exclude, None if none was."""
+        if self.played is None:
+            self.load()
+        played, name = max(((played, name) for name, played in self.played.items()
+                if name != exclude), default=(0, None))
+        return name if played else None
+
+    def mark_played(self, name, when=None, jump=False):
+        """Record that a bookmarked file was played now, or at unix time when.
+
+        jump tells that the file was reached by a jump in played order,
+        it then keeps its place in that order. Marking the most recently
+        played file again, as the player state does after a jump, keeps
+        the place too.
+        """
+        if when is None:
+            when = time.time()
+        with self.db.batch():
+            if jump:
+                self.db.conn.execute("UPDATE file_metadata SET previous_played=coalesce(previous_played, played, 0), played=? WHERE name=?",
+                        (when, name))
+            else:
+                self.db.conn.execute("UPDATE file_metadata SET previous_played=CASE WHEN played >= (SELECT max(played) FROM file_metadata) THEN previous_played END, played=? WHERE name=?",
+                        (when, name))
+            row = self.db.conn.execute("SELECT previous_played FROM file_metadata WHERE name=?", (name,)).fetchone()
+        if self.played is not None and name in self.played:
+            keys = self.keys['played']
+            key = self.key('played', name)
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del keys[i]
+            self.played[name] = when
+            if row is not None and row[0] is not None:
+                self.previous_played[name] = row[0]
+            else:
+                self.previous_played.pop(name, None)
+            bisect.insort(keys, self.key('played', name))
+
+HistoryEntry = collections.namedtuple('HistoryEntry',
+        ['seq', 'name', 'start_position', 'position', 'started', 'updated'])
+
+class PlaybackHistory:
+    """What was played, as entries of a file played from one position to
+    another, stored in a ring buffer table of capacity entries.
+
+    observe() is given every player status polled. It extends the entry
+    being played while the position advances as expected, and starts a
+    new one when the file changes or the position jumps. Entries are
+    only written by flush(), all changed ones in one transaction, so
+    polling doesn't commit every second. A new entry's seq is None until
+    flush() writes it: seqs are allocated by the insert itself, so
+    entries written meanwhile by another instance aren't overwritten.
+    """
+
+    capacity = 10000
+    # seconds the position may be off from where it should be before it
+    # counts as a jump
+    jump_tolerance = 10
+
+    def __init__(self, db):
+        self.db = db
+        self.current = None
+        # key -> entry changed since the last flush, written entries are
+        # keyed by their seq and new ones by negative numbers
+        self.pending = {}
+        self.current_key = None
+        self.new_entries = 0
+
+    def observe(self, status, now=None):
+        if not status.has_file or status.current_sec < 0:
+            return
+        if now is None:
+            now = time.time()
+        entry = self.current
+        if entry is not None and entry.name == status.file:
+            expected = entry.position
+            if status.state == 'PLAY':
+                expected += now - entry.updated
+            if abs(status.current_sec - expected) <= self.jump_tolerance:
+                self.current = entry._replace(position=status.current_sec, updated=now)
+                self.pending[self.current_key] = self.current
+                return
+        self.new_entries += 1
+        self.current_key = -self.new_entries
+        self.current = HistoryEntry(None, status.file, status.current_sec,
+                status.current_sec, now, now)
+        self.pending[self.current_key] = self.current
+
+    def flush(self):
+        """Write the entries changed since the last flush."""
+        if not self.pending:
+            return
+        entries, self.pending = self.pending, {}
+        with self.db.batch():
+            for key, entry in entries.items():
+                if entry.seq is not None:
+                    self.db.conn.execute("UPDATE playback_history SET position=?, updated=? WHERE seq=?",
+                            (entry.position, entry.updated, entry.seq))
+                    continue
+                # the slot of the next seq holds the entry capacity before it
+                cursor = self.db.conn.execute("INSERT OR REPLACE INTO playback_history (slot, seq, name, start_position, position, started, updated) SELECT seq % ?, seq, ?, ?, ?, ?, ? FROM (SELECT coalesce(max(seq), 0) + 1 AS seq FROM playback_history)",
+                        (self.capacity,) + tuple(entry[1:]))
+                seq = self.db.conn.execute("SELECT seq FROM playback_history WHERE slot=?", (cursor.lastrowid,)).fetchone()[0]
+                if key == self.current_key:
+                    self.current = self.current._replace(seq=seq)
+                    self.current_key = seq
+
+    def last(self):
+        """The most recent entry, None if nothing was played."""
+        if self.current is not None:
+            return self.current
+        row = self.db.conn.execute("SELECT seq, name, start_position, position, started, updated FROM playback_history ORDER BY seq DESC LIMIT 1").fetchone()
+        return None if row is None else HistoryEntry(*row)
+
+class HistorySource:
+    """The playback history, most recent first, paged with keyset
+    pagination like KeysetBookmarkSource. Keys are (-seq,)."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def key(self, entry):
+        return (-entry.seq,)
+
+    def rows(self, key=None, direction='after', limit=100):
+        columns = "seq, name, start_position, position, started, updated"
+        cursor = self.db.conn.cursor()
+        if key is None and direction == 'before':
+            cursor.execute("SELECT %s FROM playback_history ORDER BY seq ASC LIMIT ?" % columns, (limit,))
+            return [HistoryEntry(*row) for row in reversed(cursor.fetchall())]
+        if key is None:
+            cursor.execute("SELECT %s FROM playback_history ORDER BY seq DESC LIMIT ?" % columns, (limit,))
+        elif direction == 'before':
+            cursor.execute("SELECT %s FROM playback_history WHERE seq > ? ORDER BY seq ASC LIMIT ?" % columns, (-key[0], limit))
+            return [HistoryEntry(*row) for row in reversed(cursor.fetchall())]
+        elif direction == 'after':
+            cursor.execute("SELECT %s FROM playback_history WHERE seq < ? ORDER BY seq DESC LIMIT ?" % columns, (-key[0], limit))
+        else:
+            cursor.execute("SELECT %s FROM playback_history WHERE seq <= ? ORDER BY seq DESC LIMIT ?" % columns, (-key[0], limit))
+        return [HistoryEntry(*row) for row in cursor]
+
+    def find(self, entry):
+        return self.key(entry)
+
+    def accept(self, row):
+        return None
+
+    def discard(self, row):
+        pass
+
+class RandomBookmarkSampler:
+    """Picks random bookmarks, weighted by rating, without loading ids.
+
+    The bookmarks are counted per rating at the first pick, from the
+    rating index, or with search_string, a query for compile_query(),
+    from its matches. Where there are few candidates per bookmark to
+    pick from, random candidates are tried, each one found kept with
+    the probability of its rating's weight: ids between the lowest and
+    the highest, or with words to search for, the full text index's
+    matches by offset. Otherwise an alias table over the ratings' total
+    weights picks a rating, and the bookmark at a random offset in its
+    rows is read, which reads up to as many index entries as it has
+    bookmarks. Only the counts and the id range are kept; change
+    notifications keep them current, or with a search have them
+    counted again. The no_repeat most recent picks are skipped while
+    there are others to pick.
+    """
+
+    # picks rejected as recent or deleted meanwhile before giving up
+    max_tries = 20
+    # random ids are tried while there are at most max_spread per
+    # bookmark to pick from, up to max_probes of them per pick; matches
+    # of the full text index cost more to read, so fewer are tried
+    max_spread = 20
+    max_probes = 400
+    max_match_spread = 4
+    max_match_probes = 20
+
+    def __init__(self, db, min_rating=None, search_string=None, no_repeat=20):
+        import random
+        self.db = db
+        self.min_rating = min_rating
+        self.search_string = search_string or None
+        self.random = random.Random()
+        self.recent = collections.deque(maxlen=no_repeat)
+        # rating -> number of bookmarks, counted at the first pick
+        self.counts = None
+        # lowest and highest bookmark id, and the number of matches of
+        # the words searched for, None without
+        self.id_range = (None, None)
+        self.match_count = None
+        self.alias = None
+        db.listen(self.bookmark_changed)
+
+    @staticmethod
+    def bucket(rating):
+        return rating or 0
+
+    @staticmethod
+    def weight(rating):
+        """Unrated bookmarks are picked as often as those rated 0, every
+        star adds as much again."""
+        return 1 + (rating or 0)
+
+    def query(self):
+        return compile_query(self.search_string or '')
+
+    def count(self):
+        self.counts = {}
+        self.alias = None
+        query = self.query()
+        cursor = self.db.conn.cursor()
+        if query.where is not None:
+            cursor.execute("SELECT rating, count(*) FROM bookmarks WHERE %s GROUP BY rating" % query.where, query.params)
+        else:
+            cursor.execute("SELECT rating, count(*) FROM bookmarks GROUP BY rating")
+        for rating, count in cursor:
+            if self.bucket(rating) >= (self.min_rating or 0):
+                self.counts[self.bucket(rating)] = self.counts.get(self.bucket(rating), 0) + count
+        cursor.execute("SELECT min(id), max(id) FROM bookmarks")
+        self.id_range = cursor.fetchone()
+        self.match_count = None
+        if query.match != '':
+            self.match_count = self.db.count_matches(self.search_string)
+
+    def probe(self):
+        """Return the id of a random bookmark found by trying candidates,
+        None if there are too many per bookmark or none was found."""
+        total = sum(self.counts.values())
+        if total == 0:
+            return None
+        query = self.query()
+        cursor = self.db.conn.cursor()
+        if self.match_count is None:
+            low, high = self.id_range
+            if low is None or high - low + 1 > total * self.max_spread:
+                return None
+            tries = self.max_probes
+            def candidate():
+                return self.random.randint(low, high)
+        else:
+            if self.match_count > total * self.max_match_spread:
+                return None
+            tries = self.max_match_probes
+            def candidate():
+                cursor.execute("SELECT rowid FROM bookmarks_fts WHERE bookmarks_fts MATCH ? LIMIT 1 OFFSET ?",
+                        (query.match, self.random.randrange(self.match_count)))
+                row = cursor.fetchone()
+                return None if row is None else row[0]
+        # the rating and pos fields, the words are matched already
+        conditions, params = ['1'], ()
+        if self.min_rating:
+            conditions.append('rating >= ?')
+            params += (self.min_rating,)
+        if query.filter is not None:
+            conditions.append(query.filter)
+            params += query.filter_params
+        max_weight = max(self.weight(rating) for rating, count in self.counts.items() if count)
+        for _ in range(tries):
+            bookmark_id = candidate()
+            if bookmark_id is None:
+                continue
+            cursor.execute("SELECT rating FROM bookmarks WHERE id=? AND %s" % ' AND '.join(conditions),
+                    (bookmark_id,) + params)
+            row = cursor.fetchone()
+            if row is not None and self.random.random() * max_weight < self.weight(row[0]):
+                return bookmark_id
+        return None
+
+    def choose(self, rating):
+        """Return the id of a random bookmark of rating, None if none was found."""
+        if rating == 0:
+            where, params = '(rating IS NULL OR rating = 0)', ()
+        else:
+            where, params = 'rating = ?', (rating,)
+        query = self.query()
+        if query.where is not None:
+            where, params = '%s AND %s' % (where, query.where), params + query.params
+        # without an ORDER BY the rows come in index order, any fixed
+        # order makes a random offset pick each of them as often
+        cursor = self.db.conn.cursor()
+        cursor.execute("SELECT id FROM bookmarks WHERE %s LIMIT 1 OFFSET ?" % where,
+                params + (self.random.randrange(self.counts[rating]),))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def build_alias(self):
+        """Vose's alias table over the ratings, as (rating, probability, alias rating)."""
+        weights = [(rating, self.weight(rating) * count) for rating, count in self.counts.items() if count]
+        total = sum(weight for rating, weight in weights)
+        scaled = [[rating, weight * len(weights) / total] for rating, weight in weights]
+        small = [entry for entry in scaled if entry[1] < 1]
+        large = [entry for entry in scaled if entry[1] >= 1]
+        table = []
+        while small and large:
+            entry, other = small.pop(), large[-1]
+            table.append((entry[0], entry[1], other[0]))
+            other[1] -= 1 - entry[1]
+            if other[1] < 1:
+                small.append(large.pop())
+        table.extend((entry[0], 1.0, entry[0]) for entry in small + large)
+        self.alias = table
+
+    def add(self, row):
+        rating = self.bucket(row[2])
+        if rating < (self.min_rating or 0):
+            return
+        self.counts[rating] = self.counts.get(rating, 0) + 1
+        low, high = self.id_range
+        self.id_range = (row[0] if low is None else min(low, row[0]),
+                row[0] if high is None else max(high, row[0]))
+        self.alias = None
+
+    def remove(self, row):
+        rating = self.bucket(row[2])
+        if self.counts.get(rating):
+            self.counts[rating] -= 1
+            self.alias = None
+
+    def bookmark_changed(self, change, row, old_row):
+        if self.counts is None:
+            return
+        if change == 'reload' or self.search_string is not None:
+            # whether a changed bookmark matched the search can't be told
+            # any more, the matches are counted again at the next pick
+            self.counts = None
+        elif change == 'add':
+            self.add(row)
+        elif change == 'delete':
+            self.remove(row)
+        elif change == 'update':
+            self.remove(old_row)
+            self.add(row)
+
+    def pick(self):
+        """Return a random bookmark row, None if there are none to pick from."""
+        if self.counts is None:
+            self.count()
+        row = None
+        for _ in range(self.max_tries):
+            bookmark_id = self.probe()
+            if bookmark_id is None:
+                if self.alias is None:
+                    self.build_alias()
+                if not self.alias:
+                    return None
+                rating, probability, alias = self.alias[self.random.randrange(len(self.alias))]
+                if self.random.random() >= probability:
+                    rating = alias
+                bookmark_id = self.choose(rating)
+            if bookmark_id is None:
+                continue
+            if bookmark_id in self.recent and row is not None:
+                continue
+            candidate = self.db.get_bookmark(bookmark_id)
+            if candidate is None:
+                # deleted by another instance, the reload will follow
+                continue
+            row = candidate
+            if bookmark_id not in self.recent:
+                break
+        if row is not None:
+            self.recent.append(row[0])
+        return row
+
+    def close(self):
+        self.db.unlisten(self.bookmark_changed)
+
+class PlayingController():
+    """Decides which bookmark to play and plays it.
+
+    Lookups only use in-memory indexes. Playing goes through MocController
+    and blocks until the player confirms it, the UI therefore resolves
+    the bookmark itself and runs play_bookmark() on its player thread.
+    The play_* methods do both, for callers that may block.
+    """
+
+    def __init__(self, db, moc, zapping_tolerance=ZAPPING_TOLERANCE):
+        self.db = db
+        self.moc = moc
+        self.zapping_tolerance = zapping_tolerance
+        self.positions = FilePositionIndex(db)
+        self.files = FileIndex(db)
+        self.history = PlaybackHistory(db)
+        self.sampler = None
+        # order of the files for next_file_bookmark(), see FileIndex.orders
+        self.file_order = 'path'
+        # whether jumping to a file plays its best rated bookmark, not its first
+        self.play_best_rated = False
+        # seconds before the position left off resume() starts playing
+        self.resume_rewind = 5
+
+    def next_bookmark(self, status):
+        if not status.has_file:
+            return None
+        return self.positions.next(status.file, status.current_sec)
+
+    def previous_bookmark(self, status):
+        if not status.has_file:
+            return None
+        return self.positions.previous(status.file, status.current_sec, self.zapping_tolerance)
+
+    def file_bookmark(self, filename):
+        """The bookmark a jump to filename plays, see play_best_rated."""
+        if filename is None:
+            return None
+        rows = self.positions.get_bookmarks(filename)
+        if not rows:
+            return None
+        if self.play_best_rated:
+            # the earliest of the highest rated
+            return max(rows, key=lambda row: (row[2] or 0, -row[3]))
+        return rows[0]
+
+    def jump_to_file(self, filename):
+        """The bookmark to play in filename, which a jump in played order
+        marks played as such, see FileIndex."""
+        row = self.file_bookmark(filename)
+        if row is not None and self.file_order == 'played':
+            self.files.mark_played(filename, jump=True)
+        return row
+
+    def next_file_bookmark(self, status):
+        """The bookmark to play in the file after the playing one."""
+        return self.jump_to_file(self.files.next(status.file if status.has_file else None, self.file_order))
+
+    def previous_file_bookmark(self, status):
+        return self.jump_to_file(self.files.previous(status.file if status.has_file else None, self.file_order))
+
+    def most_recent_file_bookmark(self, status):
+        """The bookmark to play in the most recently played file other than the playing one."""
+        return self.file_bookmark(self.files.most_recent(status.file if status.has_file else None))
+
+    def play_bookmark(self, b):
+        return self.moc.play_at(b['filename'], b['position'])
+
+    def play_row(self, row):
+        if row is None:
+            return None
+        return self.play_bookmark(bookmark_from_row(row))
+
+    def random_bookmark(self, min_rating=None, search_string=None):
+        """A random bookmark weighted by rating, see RandomBookmarkSampler."""
+        search_string = (search_string or '').strip() or None
+        if self.sampler is None or (self.sampler.min_rating, self.sampler.search_string) != (min_rating, search_string):
+            previous = self.sampler
+            self.sampler = RandomBookmarkSampler(self.db, min_rating, search_string)
+            if previous is not None:
+                previous.close()
+                self.sampler.recent.extend(previous.recent)
+        return self.sampler.pick()
+
+    def play_random_bookmark(self, min_rating=None, search_string=None):
+        return self.play_row(self.random_bookmark(min_rating, search_string))
+
+    def play_first_file_bookmark(self):
+        status = self.moc.get_status()
+        return self.play_row(self.positions.first(status.file) if status.has_file else None)
+
+    def play_last_file_bookmark(self):
+        status = self.moc.get_status()
+        return self.play_row(self.positions.last(status.file) if status.has_file else None)
+
+    def play_next_file(self):
+        return self.play_row(self.next_file_bookmark(self.moc.get_status()))
+
+    def play_previous_file(self):
+        return self.play_row(self.previous_file_bookmark(self.moc.get_status()))
+
+    def play_next_bookmark(self):
+        return self.play_row(self.next_bookmark(self.moc.get_status()))
+
+    def play_previous_bookmark(self):
+        return self.play_row(self.previous_bookmark(self.moc.get_status()))
+
+    def play_bookmark_by_id(self, bookmark_id):
+        return self.play_row(self.db.get_bookmark(bookmark_id))
+
+    def resume(self):
+        """Play the file played last from a little before where it was left,
+        or else a bookmark of the most recently played file. Returns the
+        timings and the file and position played, None if nothing was
+        played before."""
+        entry = self.history.last()
+        if entry is not None:
+            position = max(0, entry.position - self.resume_rewind)
+            return self.moc.play_at(entry.name, position), entry.name, position
+        row = self.most_recent_file_bookmark(self.moc.get_status())
+        if row is None:
+            return None
+        return self.play_row(row), row[1], row[3]
+
+    def play_most_recent_file(self):
+        result = self.resume()
+        return None if result is None else result[0]
+
+@functools.lru_cache(maxsize=None)
+def format_rating(rating):
+    if rating is not None and rating > 0:
+        remaining = MAX_RATING - rating
+        return "%s%s" % (rating * ' ★', remaining * ' ☆')
+    return MAX_RATING * ' ☆'
+
+def format_file_node(node, expanded=False):
+    average = '%.1f' % node.average_rating if node.average_rating is not None else '-'
+    return '{:s} {:50s}{:5d} bookmarks  avg {:>3s}  max {:5s} last {:s}'.format(
+            '▾' if expanded else '▸', os.path.basename(node.name), node.count, average,
+            format_rating(node.max_rating).replace(' ', ''), node.last_added or '')
+
+def format_history_line(entry):
+    return '{:16s}  {:50s}{:>14s} - {:s}'.format(
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.started)),
+            os.path.basename(entry.name), format_seconds(entry.start_position),
+            format_seconds(entry.position))
+
+# rows are tuples of the stored values, so a changed bookmark is a new key
+@functools.lru_cache(maxsize=4096)
+def format_bookmark_line(row, present=None, duration=None):
+    """present is False for a file known to be missing, duration the
+    file's length in seconds if known."""
+    name = os.path.basename(row[1])
+    if present is False:
+        name = '✗ ' + name
+    fraction = '{:3.0f}%'.format(100 * row[3] / duration) if duration else ''
+    return '{:<5d}{:50s}{:5d}{:>5s}{:5s} {:s}'.format(row[0], name, row[3], fraction, format_rating(row[2]), row[4] or '')
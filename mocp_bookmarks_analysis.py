@@ -0,0 +1,247 @@
+#encoding=utf-8
+
+# Suggests bookmarks at likely track changes of long recordings, from
+# silences and changes of the loudness. Needs numpy, WAV files are read
+# with the wave module, anything else is decoded by ffmpeg if installed.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import wave
+import collections
+import concurrent.futures
+
+import numpy
+
+from mocp_bookmarks import PeakCache
+
+Suggestion = collections.namedtuple('Suggestion', ['position', 'kind', 'score'])
+AnalysisResult = collections.namedtuple('AnalysisResult', ['filename', 'suggestions', 'error'])
+
+# loudness windows per chunk read from the decoder, so chunks always
+# hold whole windows
+WINDOWS_PER_CHUNK = 20
+# ffmpeg decodes to mono at this rate, plenty for loudness
+FFMPEG_RATE = 22050
+
+def pcm_to_mono(data, sample_width, channels):
+    """Convert interleaved little endian PCM to mono floats in [-1, 1]."""
+    if sample_width == 1:
+        samples = (numpy.frombuffer(data, numpy.uint8).astype(numpy.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = numpy.frombuffer(data, '<i2').astype(numpy.float32) / 32768
+    elif sample_width == 3:
+        b = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+        values = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        samples = ((values << 8) >> 8).astype(numpy.float32) / 8388608
+    elif sample_width == 4:
+        samples = numpy.frombuffer(data, '<i4').astype(numpy.float32) / 2147483648
+    else:
+        raise ValueError("unsupported sample width of %d bytes" % sample_width)
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+def read_wav_chunks(path, window_seconds):
+    """Yield (mono samples, sample rate) of a PCM WAV file, chunk by chunk."""
+    try:
+        with wave.open(path, 'rb') as wav:
+            channels = wav.getnchannels()
+            sample_width = wav.getsampwidth()
+            rate = wav.getframerate()
+            frames = max(1, int(rate * window_seconds)) * WINDOWS_PER_CHUNK
+            while True:
+                data = wav.readframes(frames)
+                if not data:
+                    return
+                yield pcm_to_mono(data, sample_width, channels), rate
+    except (wave.Error, EOFError) as e:
+        raise ValueError("%s: not a PCM WAV file: %s" % (path, e))
+
+def read_ffmpeg_chunks(path, window_seconds):
+    """Yield (mono samples, sample rate) of any file ffmpeg can decode."""
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise ValueError("%s: only WAV files can be analysed without ffmpeg" % path)
+    chunk_size = max(1, int(FFMPEG_RATE * window_seconds)) * WINDOWS_PER_CHUNK * 2
+    # errors go to a file: a pipe only read at the end would stop ffmpeg
+    # once its buffer is full, while we wait for output
+    errors = tempfile.TemporaryFile()
+    try:
+        proc = subprocess.Popen([ffmpeg, '-nostdin', '-v', 'error', '-i', path,
+                '-f', 's16le', '-ac', '1', '-ar', str(FFMPEG_RATE), '-'],
+                stdout=subprocess.PIPE, stderr=errors)
+    except OSError:
+        errors.close()
+        raise
+    finished = False
+    try:
+        while True:
+            data = proc.stdout.read(chunk_size)
+            if not data:
+                break
+            yield pcm_to_mono(data[:len(data) - len(data) % 2], 2, 1), FFMPEG_RATE
+        finished = True
+    finally:
+        if not finished:
+            # closed or failed before the end: ffmpeg's exit status
+            # would only report the closed pipe
+            proc.kill()
+        proc.stdout.close()
+        status = proc.wait()
+        # the last of the messages, ffmpeg may repeat one for every frame
+        errors.seek(max(0, os.fstat(errors.fileno()).st_size - 1000))
+        error = errors.read().decode('utf-8', 'replace').strip()
+        errors.close()
+        if status != 0 and finished:
+            raise ValueError("%s: ffmpeg failed: %s" % (path, error))
+
+def read_audio_chunks(path, window_seconds):
+    if path.lower().endswith('.wav'):
+        return read_wav_chunks(path, window_seconds)
+    return read_ffmpeg_chunks(path, window_seconds)
+
+class TransitionDetector:
+    """Finds likely track changes in the loudness of a recording.
+
+    The loudness is measured in windows of window_seconds and fed in as
+    it is decoded. Suggested are the ends of silences, and windows where
+    the mean loudness of the context_seconds before and after differs,
+    or dips below both, by change_db or more. Only the strongest of the
+    suggestions within min_gap seconds is kept. Memory use only depends
+    on the settings, not on the length of the recording.
+    """
+
+    window_seconds = 0.5
+    # dBFS below which a window counts as silence, and how long it has to last
+    silence_db = -45.0
+    min_silence = 1.0
+    # digital silence would be -inf dB and outweigh everything else
+    floor_db = -90.0
+    context_seconds = 8.0
+    change_db = 6.0
+    min_gap = 60.0
+
+    def __init__(self, **settings):
+        for name, value in settings.items():
+            if not hasattr(TransitionDetector, name):
+                raise TypeError("unknown setting %r" % name)
+            setattr(self, name, value)
+        if self.window_seconds <= 0:
+            raise ValueError("window_seconds has to be positive, not %r" % self.window_seconds)
+        self.context = max(1, int(self.context_seconds / self.window_seconds))
+        self.history = collections.deque(maxlen=2 * self.context + 1)
+        self.window = 0
+        self.silent_windows = 0
+        self.pending = None
+        self.remainder = numpy.zeros(0, numpy.float32)
+
+    def loudness(self, samples, rate):
+        """dBFS of every whole window of samples, the rest is kept for the next call."""
+        size = max(1, int(rate * self.window_seconds))
+        samples = numpy.concatenate((self.remainder, samples)) if len(self.remainder) else samples
+        whole = len(samples) - len(samples) % size
+        self.remainder = samples[whole:]
+        windows = samples[:whole].reshape(-1, size)
+        rms = numpy.sqrt(numpy.mean(windows * windows, axis=1))
+        return 20 * numpy.log10(numpy.maximum(rms, 10 ** (self.floor_db / 20)))
+
+    def feed(self, samples, rate):
+        """Take the next chunk of mono samples, yield the suggestions it settles."""
+        for db in self.loudness(samples, rate).tolist():
+            yield from self.feed_window(db)
+
+    def feed_window(self, db):
+        position = self.window * self.window_seconds
+        self.window += 1
+        if db < self.silence_db:
+            self.silent_windows += 1
+        else:
+            silence = self.silent_windows * self.window_seconds
+            self.silent_windows = 0
+            if silence >= self.min_silence and position - silence > 0:
+                # silences are surer than loudness changes
+                yield from self.suggest(Suggestion(position, 'silence', 100 + silence))
+
+        self.history.append(db)
+        if len(self.history) == self.history.maxlen:
+            values = list(self.history)
+            before = sum(values[:self.context]) / self.context
+            after = sum(values[-self.context:]) / self.context
+            # the windows next to the center, fewer for a short context
+            around = values[max(0, self.context - 2):self.context + 3]
+            local = sum(around) / len(around)
+            score = abs(after - before) + max(0.0, min(before, after) - local)
+            if score >= self.change_db:
+                center = (self.window - 1 - self.context) * self.window_seconds
+                yield from self.suggest(Suggestion(center, 'change', score))
+
+    def suggest(self, suggestion):
+        if self.pending is None:
+            self.pending = suggestion
+        elif suggestion.position - self.pending.position < self.min_gap:
+            if suggestion.score > self.pending.score:
+                self.pending = suggestion
+        else:
+            yield self.pending
+            self.pending = suggestion
+
+    def finish(self):
+        if self.pending is not None:
+            yield self.pending
+            self.pending = None
+
+def analyze_file(filename, settings=None):
+    """Return the suggestions for one file, positions in whole seconds."""
+    detector = TransitionDetector(**(settings or {}))
+    suggestions = []
+    for samples, rate in read_audio_chunks(filename, detector.window_seconds):
+        suggestions.extend(detector.feed(samples, rate))
+    suggestions.extend(detector.finish())
+    return [Suggestion(int(round(s.position)), s.kind, round(s.score, 1)) for s in suggestions]
+
+def compute_peaks(filename, seconds_per_peak=PeakCache.seconds_per_peak):
+    """Return the highest level of every seconds_per_peak of a recording,
+    a byte from 0 to 255 each, in one streaming pass."""
+    peaks = bytearray()
+    remainder = numpy.zeros(0, numpy.float32)
+    for samples, rate in read_audio_chunks(filename, seconds_per_peak):
+        size = max(1, int(rate * seconds_per_peak))
+        samples = numpy.concatenate((remainder, samples)) if len(remainder) else samples
+        whole = len(samples) - len(samples) % size
+        remainder = samples[whole:]
+        if whole:
+            levels = numpy.abs(samples[:whole]).reshape(-1, size).max(axis=1)
+            peaks += numpy.minimum(levels * 255, 255).astype(numpy.uint8).tobytes()
+    if len(remainder):
+        peaks.append(min(255, int(numpy.abs(remainder).max() * 255)))
+    return bytes(peaks)
+
+def cache_peaks(filename, cache_directory=None):
+    """Compute the peak summary of filename into the PeakCache."""
+    cache = PeakCache(cache_directory)
+    cache.put(filename, compute_peaks(filename, cache.seconds_per_peak), cache.seconds_per_peak)
+
+def _analyze(filename, settings):
+    try:
+        return AnalysisResult(filename, analyze_file(filename, settings), None)
+    except (OSError, ValueError) as e:
+        return AnalysisResult(filename, [], str(e))
+
+def analyze_files(filenames, settings=None, jobs=None):
+    """Analyse files in parallel processes, yield an AnalysisResult per
+    file as it is done."""
+    jobs = min(jobs or os.cpu_count() or 1, len(filenames))
+    if jobs <= 1:
+        for filename in filenames:
+            yield _analyze(filename, settings)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(_analyze, filename, settings) for filename in filenames]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+def suggestion_bookmarks(filename, suggestions):
+    """Import tuples for BookmarkDatabase.import_bookmarks() of accepted suggestions."""
+    return [(filename, s.position, None, 'suggested: %s' % s.kind, None) for s in suggestions]
@@ -0,0 +1,310 @@
+#encoding=utf-8
+
+# The command line of mocp-bookmark-manager.py. The commands only need
+# mocp_bookmarks, the urwid interface is imported when it is started, so
+# e.g. bookmarking from a window manager hotkey doesn't pay for loading
+# it.
+
+import sys
+import os
+import itertools
+import time
+import types
+
+from mocp_bookmarks import (DATABASE_PATH, BookmarkDatabase, MocSocketController,
+        PlayerStatus, PlayingController, KeysetBookmarkSource, HistorySource, FileIndex,
+        FileRelinker, export_cue_sheets, read_bookmarks, write_bookmarks_csv, write_bookmarks_jsonl,
+        latency_stats, bookmark_source)
+
+def print_bookmark(row):
+    """Print a bookmark as tab separated id, position, rating, file and comment."""
+    print('%d\t%d\t%s\t%s\t%s' % (row[0], row[3], row[2] or '', row[1], row[4] or ''))
+
+def add_bookmark(db, moc, args):
+    status = moc.get_status()
+    if not status.has_file:
+        print("nothing to bookmark, player state: %s" % status.state, file=sys.stderr)
+        return 1
+    print_bookmark(db.add(status.file, status.current_sec, args.rating, args.comment))
+    return 0
+
+def record_play(player, filename, position):
+    """Record in the database that filename was played from position."""
+    player.files.mark_played(filename)
+    player.history.observe(PlayerStatus('PLAY', filename, position, -1, None))
+    player.history.flush()
+
+def play_row(player, row):
+    """Play and print a bookmark, returns the exit status."""
+    timings = player.play_row(row)
+    record_play(player, row[1], row[3])
+    print_bookmark(row)
+    return 0 if all(confirmed for step, seconds, confirmed in timings) else 1
+
+def resume(db, moc, args):
+    player = PlayingController(db, moc)
+    result = player.resume()
+    if result is None:
+        print("nothing was played yet", file=sys.stderr)
+        return 1
+    timings, filename, position = result
+    record_play(player, filename, position)
+    print('%d\t%s' % (position, filename))
+    return 0 if all(confirmed for step, seconds, confirmed in timings) else 1
+
+def print_history(db, moc, args):
+    """Print the playback history, most recent first, as tab separated start
+    time, first and last position and file."""
+    for entry in itertools.islice(HistorySource(db).rows(None, 'after', args.limit), args.limit):
+        print('%s\t%d\t%d\t%s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry.started)),
+                entry.start_position, entry.position, entry.name))
+    return 0
+
+def play_relative_bookmark(db, moc, args):
+    """Play the bookmark PlayingController's args.lookup method returns for the player status."""
+    player = PlayingController(db, moc)
+    player.file_order = getattr(args, 'order', player.file_order)
+    player.play_best_rated = getattr(args, 'best', False)
+    status = moc.get_status()
+    row = getattr(player, args.lookup)(status)
+    if row is None:
+        print("no %s bookmark, player state: %s" % (args.command, status.describe()), file=sys.stderr)
+        return 1
+    return play_row(player, row)
+
+def play_random_bookmark(db, moc, args):
+    player = PlayingController(db, moc)
+    try:
+        row = player.random_bookmark(args.rating, ' '.join(args.search or []))
+    except ValueError as e:
+        print("invalid search: %s" % e, file=sys.stderr)
+        return 1
+    if row is None:
+        print("no bookmark to play", file=sys.stderr)
+        return 1
+    return play_row(player, row)
+
+def list_bookmarks(db, moc, args):
+    filepath = args.file
+    if args.playing:
+        status = moc.get_status()
+        if not status.has_file:
+            print("nothing is playing, player state: %s" % status.state, file=sys.stderr)
+            return 1
+        filepath = status.file
+    if args.rating is not None:
+        rows = db.get_bookmarks_by_rating(args.rating, '>=', filepath)
+    elif filepath is not None:
+        rows = db.get_bookmarks_by_file(filepath)
+    else:
+        rows = KeysetBookmarkSource(db, ('name', 'position', 'id')).iter_rows()
+    for row in rows:
+        print_bookmark(row)
+    return 0
+
+def suggest_bookmarks(db, moc, args):
+    try:
+        from mocp_bookmarks_analysis import analyze_files, suggestion_bookmarks
+    except ImportError as e:
+        print("analysing recordings needs numpy: %s" % e, file=sys.stderr)
+        return 1
+    filenames = [os.path.abspath(filename) for filename in args.files]
+    if not filenames:
+        status = moc.get_status()
+        if not status.has_file:
+            print("no file given and nothing playing, player state: %s" % status.state, file=sys.stderr)
+            return 1
+        filenames = [status.file]
+    settings = { 'min_gap': args.min_gap, 'silence_db': args.silence_db }
+    bookmarks = []
+    failed = 0
+    for result in analyze_files(filenames, settings, args.jobs):
+        if result.error is not None:
+            print("failed: %s" % result.error, file=sys.stderr)
+            failed += 1
+        for s in result.suggestions:
+            print('%s\t%d\t%s\t%.1f' % (result.filename, s.position, s.kind, s.score))
+        bookmarks.extend(suggestion_bookmarks(result.filename, result.suggestions))
+    if args.add:
+        print("%d bookmarks added" % db.import_bookmarks(bookmarks).added, file=sys.stderr)
+    return 1 if failed else 0
+
+def search_bookmarks(db, moc, args):
+    try:
+        source = bookmark_source(db, ' '.join(args.words), ('name', 'position', 'id'))
+    except ValueError as e:
+        print("invalid search: %s" % e, file=sys.stderr)
+        return 1
+    for row in itertools.islice(source.iter_rows(), args.limit):
+        print_bookmark(row)
+    return 0
+
+def relink_bookmarks(db, moc, args):
+    directories = [os.path.abspath(directory) for directory in args.directories]
+    result = FileRelinker(db).relink(directories, args.dry_run)
+    for old_name, new_name in result.relinked:
+        print('%s\t%s' % (old_name, new_name))
+    for names, paths in result.ambiguous:
+        print("ambiguous: %s matches %s" % (', '.join(names), ', '.join(paths)), file=sys.stderr)
+    for name in result.unknown:
+        print("missing, never fingerprinted: %s" % name, file=sys.stderr)
+    for name, error in result.failed:
+        print("failed: %s" % error, file=sys.stderr)
+    print("%d files fingerprinted, %d missing, %d %s" % (result.fingerprinted, result.missing,
+            len(result.relinked), 'would be relinked' if args.dry_run else 'relinked'), file=sys.stderr)
+    return 0 if len(result.relinked) == result.missing else 1
+
+# the commands window manager hotkeys run, with the defaults of their
+# options: given without options they are run without building the
+# argument parser, which costs more than the command
+HOTKEY_COMMANDS = {
+    'add': { 'func': add_bookmark, 'rating': None, 'comment': '' },
+    'next': { 'func': play_relative_bookmark, 'lookup': 'next_bookmark' },
+    'prev': { 'func': play_relative_bookmark, 'lookup': 'previous_bookmark' },
+    'next-file': { 'func': play_relative_bookmark, 'lookup': 'next_file_bookmark',
+            'order': 'path', 'best': False },
+    'prev-file': { 'func': play_relative_bookmark, 'lookup': 'previous_file_bookmark',
+            'order': 'path', 'best': False },
+    'resume': { 'func': resume },
+    'random': { 'func': play_random_bookmark, 'rating': None, 'search': None },
+}
+
+def run(args):
+    if hasattr(args, 'func'):
+        db = BookmarkDatabase(args.database)
+        moc = MocSocketController()
+        try:
+            return args.func(db, moc, args)
+        finally:
+            moc.disconnect()
+            db.close()
+
+    if args.command == 'export' and args.format == 'cue':
+        result = export_cue_sheets(args.database, args.all)
+        print("%d cue sheets written, %d removed" % (result.written, result.removed))
+        for filename, error in result.failed:
+            print("failed: %s" % error, file=sys.stderr)
+        return 1 if result.failed else 0
+
+    if args.command == 'export':
+        write = write_bookmarks_csv if args.format == 'csv' else write_bookmarks_jsonl
+        db = BookmarkDatabase(args.database)
+        try:
+            if args.output == '-':
+                write(db.iter_bookmarks(), sys.stdout)
+            else:
+                with open(args.output, 'wt', encoding='utf-8', newline='') as f:
+                    write(db.iter_bookmarks(), f)
+        finally:
+            db.close()
+        return 0
+
+    if args.command == 'import':
+        db = BookmarkDatabase(args.database)
+        try:
+            bookmarks = itertools.chain.from_iterable(
+                    read_bookmarks(path, args.format) for path in args.paths)
+            result = db.import_bookmarks(bookmarks)
+        except (OSError, ValueError) as e:
+            print("import failed, nothing was added: %s" % e, file=sys.stderr)
+            return 1
+        finally:
+            db.close()
+        print("%d bookmarks added, %d already present" % (result.added, result.read - result.added))
+        return 0
+
+    from mocp_bookmarks_tui import BookmarkManager
+    app = BookmarkManager(args.database)
+    app.run()
+    return 0
+
+def parse_arguments(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Bookmark manager for moc (music on console).")
+    parser.add_argument('--database', help="bookmark database (default: %s)" % DATABASE_PATH)
+    parser.add_argument('--stats', metavar='FILE',
+            help="write latency histograms of player commands, queries and redraws to FILE on exit")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    export = commands.add_parser('export',
+            help="write a cue sheet next to every bookmarked file, or all bookmarks to a JSONL or CSV file")
+    export.add_argument('--all', action='store_true',
+            help="rewrite all cue sheets, not only those of files with changed bookmarks")
+    export.add_argument('--format', choices=('cue', 'jsonl', 'csv'), default='cue')
+    export.add_argument('--output', '-o', default='-',
+            help="file to write JSONL or CSV to (default: stdout)")
+    import_ = commands.add_parser('import',
+            help="add bookmarks from JSONL, CSV or cue files, skipping those already present")
+    import_.add_argument('paths', nargs='+', metavar='path',
+            help="file to import, '-' for stdin, or a directory to search for cue sheets")
+    import_.add_argument('--format', choices=('cue', 'jsonl', 'csv'),
+            help="format of the files (default: by file extension)")
+    add = commands.add_parser('add', help="bookmark the playing position")
+    add.add_argument('--rating', type=int)
+    add.add_argument('--comment', default='')
+    add.set_defaults(**HOTKEY_COMMANDS['add'])
+    commands.add_parser('next', help="play the next bookmark in the playing file"
+            ).set_defaults(**HOTKEY_COMMANDS['next'])
+    commands.add_parser('prev', help="play the previous bookmark in the playing file"
+            ).set_defaults(**HOTKEY_COMMANDS['prev'])
+    for name, description in [
+            ('next-file', "play a bookmark in the bookmarked file after the playing one"),
+            ('prev-file', "play a bookmark in the bookmarked file before the playing one")]:
+        file_command = commands.add_parser(name, help=description)
+        file_command.add_argument('--order', choices=FileIndex.orders, default='path',
+                help="order of the files: by path, recording date in the name, or when last played")
+        file_command.add_argument('--best', action='store_true',
+                help="play the file's best rated bookmark instead of its first")
+        file_command.set_defaults(**HOTKEY_COMMANDS[name])
+    commands.add_parser('resume', help="play the file played last from where it was left"
+            ).set_defaults(**HOTKEY_COMMANDS['resume'])
+    history = commands.add_parser('history', help="print what was played, most recent first")
+    history.add_argument('--limit', type=int, default=50)
+    history.set_defaults(func=print_history)
+    random = commands.add_parser('random', help="play a random bookmark, higher rated ones more often")
+    random.add_argument('--rating', type=int, help="only bookmarks rated at least this")
+    random.add_argument('--search', nargs='+', metavar='word', help="only bookmarks matching the words")
+    random.set_defaults(**HOTKEY_COMMANDS['random'])
+    list_ = commands.add_parser('list', help="print bookmarks, tab separated")
+    list_.add_argument('--file', help="only bookmarks of this file")
+    list_.add_argument('--playing', action='store_true', help="only bookmarks of the playing file")
+    list_.add_argument('--rating', type=int, help="only bookmarks rated at least this")
+    list_.set_defaults(func=list_bookmarks)
+    search = commands.add_parser('search',
+            help="print the bookmarks best matching the words, or matching a query like rating>=4 pos>1h")
+    search.add_argument('words', nargs='+', metavar='word')
+    search.add_argument('--limit', type=int, default=20)
+    search.set_defaults(func=search_bookmarks)
+    suggest = commands.add_parser('suggest',
+            help="print likely track changes in recordings, found from silences and loudness changes")
+    suggest.add_argument('files', nargs='*', metavar='file',
+            help="PCM WAV file, other formats need ffmpeg (default: the playing file)")
+    suggest.add_argument('--add', action='store_true', help="add the suggestions as bookmarks")
+    suggest.add_argument('--jobs', type=int, help="files analysed in parallel (default: one per core)")
+    suggest.add_argument('--min-gap', type=float, default=60.0,
+            help="minimum seconds between two suggestions")
+    suggest.add_argument('--silence-db', type=float, default=-45.0,
+            help="loudness in dBFS below which audio counts as silence")
+    suggest.set_defaults(func=suggest_bookmarks)
+    relink = commands.add_parser('relink',
+            help="fingerprint the bookmarked files, and move the bookmarks of missing ones to the files found under directories with the same content")
+    relink.add_argument('directories', nargs='*', metavar='directory',
+            help="directory to search for moved files")
+    relink.add_argument('--dry-run', '-n', action='store_true',
+            help="only print which files would be relinked")
+    relink.set_defaults(func=relink_bookmarks)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 1 and argv[0] in HOTKEY_COMMANDS:
+        args = types.SimpleNamespace(command=argv[0], database=None, stats=None,
+                **HOTKEY_COMMANDS[argv[0]])
+    else:
+        args = parse_arguments(argv)
+
+    try:
+        return run(args)
+    finally:
+        if args.stats:
+            latency_stats.dump(args.stats)
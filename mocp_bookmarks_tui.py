@@ -0,0 +1,1266 @@
+#encoding=utf-8
+
+import urwid
+import os
+import asyncio
+import concurrent.futures
+import multiprocessing
+import functools
+import bisect
+import threading
+import time
+
+from mocp_bookmarks import (MAX_RATING, BookmarkDatabase, MocSocketController,
+        PlayingController, KeysetBookmarkSource, bookmark_source,
+        bookmark_from_row, format_timings, format_bookmark_line, export_cue_sheets,
+        latency_stats, format_seconds, PeakCache, FileMetadataStore, check_files,
+        HistorySource, format_history_line, FileNode, FileTreeSource, format_file_node)
+
+
+class SignalWrap(urwid.WidgetWrap):
+
+    def __init__(self, w, is_preemptive=False):
+        urwid.WidgetWrap.__init__(self, w)
+        self.event_listeners = []
+        self.is_preemptive = is_preemptive
+
+    def listen(self, mask, handler):
+        self.event_listeners.append((mask, handler))
+
+    def keypress(self, size, key):
+        result = key
+
+        if self.is_preemptive:
+            for mask, handler in self.event_listeners:
+                if mask is None or mask == key:
+                    result = handler(self, size, key)
+                    break
+
+        if result is not None:
+            result = self._w.keypress(size, key)
+
+        if result is not None and not self.is_preemptive:
+            for mask, handler in self.event_listeners:
+                if mask is None or mask == key:
+                    return handler(self, size, key)
+
+        return result
+
+class WaveformOverview(urwid.Widget):
+    """One line overview of the playing file: its peak levels, the
+    bookmarks in it and the playing position.
+
+    Rendering only reads the cached PeakSummary, without one just the
+    bookmarks and the position are shown.
+    """
+
+    _sizing = frozenset(['flow'])
+    level_chars = ' ▁▂▃▄▅▆▇█'
+
+    def __init__(self):
+        super().__init__()
+        self.summary = None
+        self.duration = 0
+        self.positions = []
+        self.current = None
+
+    def set(self, summary, duration, positions, current):
+        self.summary = summary
+        self.duration = duration
+        self.positions = positions
+        self.current = current
+        self._invalidate()
+
+    def rows(self, size, focus=False):
+        return 1
+
+    def column(self, position, columns):
+        if position is None or not 0 <= position <= self.duration:
+            return None
+        return min(columns - 1, int(position * columns / self.duration))
+
+    def render(self, size, focus=False):
+        (maxcol,) = size
+        markup = []
+        if self.duration > 0:
+            if self.summary is not None:
+                levels = self.summary.levels(maxcol, self.duration)
+            else:
+                levels = [None] * maxcol
+            marked = set(self.column(position, maxcol) for position in self.positions)
+            current = self.column(self.current, maxcol)
+            top = len(self.level_chars) - 1
+            for column, level in enumerate(levels):
+                char = '─' if level is None else self.level_chars[(level * top + 254) // 255]
+                if column == current:
+                    attr = 'overview position'
+                elif column in marked:
+                    attr = 'overview bookmark'
+                else:
+                    attr = 'overview'
+                if markup and markup[-1][0] == attr:
+                    markup[-1] = (attr, markup[-1][1] + char)
+                else:
+                    markup.append((attr, char))
+        return urwid.Text(markup or '', wrap='clip').render((maxcol,))
+
+class BookmarkListWalker(urwid.ListWalker):
+    """List walker showing the rows of a bookmark source.
+
+    Positions are the source's row keys. Only a window of at most
+    max_rows rows around the focus is held, further rows are fetched a
+    page at a time when the list box scrolls to them. Widgets are built
+    when a row is first displayed and dropped with it.
+    """
+
+    page_size = 100
+    max_rows = 500
+
+    def __init__(self, source, files=None):
+        # FileMetadataStore marking missing files and giving durations
+        self.files = files
+        self.set_source(source)
+
+    def set_source(self, source, focus_key=None):
+        """Show source, focused on focus_key or the row following it."""
+        self.source = source
+        self.rows = []
+        self.keys = []
+        self.widgets = {}
+        self.focus = None
+        if focus_key is None:
+            self._load(self.source.rows(None, 'after', self.page_size), True)
+        else:
+            self._load_around(focus_key)
+        self._modified()
+
+    def _load(self, rows, at_start):
+        self.rows = list(rows)
+        self.keys = [self.source.key(row) for row in self.rows]
+        self.at_start = at_start
+        self.at_end = len(self.rows) < self.page_size
+        self.focus = self.keys[0] if self.keys else None
+
+    def _load_around(self, key):
+        after = self.source.rows(key, 'from', self.page_size)
+        before = self.source.rows(key, 'before', self.page_size)
+        self.rows = before + after
+        self.keys = [self.source.key(row) for row in self.rows]
+        self.at_start = len(before) < self.page_size
+        self.at_end = len(after) < self.page_size
+        if after:
+            self.focus = self.keys[len(before)]
+        elif before:
+            self.focus = self.keys[-1]
+        else:
+            self.focus = None
+
+    def _index(self, key):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def _trim(self, keep_from, keep_to):
+        """Drop rows outside keep_from..keep_to once the window is too big."""
+        excess = len(self.rows) - self.max_rows
+        if excess <= 0:
+            return
+        drop_front = min(excess, max(0, keep_from - self.page_size))
+        for key in self.keys[:drop_front]:
+            self.widgets.pop(key, None)
+        del self.rows[:drop_front]
+        del self.keys[:drop_front]
+        if drop_front > 0:
+            self.at_start = False
+        excess -= drop_front
+        keep_to -= drop_front
+        drop_back = min(excess, max(0, len(self.rows) - keep_to - 1 - self.page_size))
+        if drop_back > 0:
+            for key in self.keys[-drop_back:]:
+                self.widgets.pop(key, None)
+            del self.rows[-drop_back:]
+            del self.keys[-drop_back:]
+            self.at_end = False
+
+    def _fetch_next(self):
+        rows = self.source.rows(self.keys[-1], 'after', self.page_size)
+        self.rows.extend(rows)
+        self.keys.extend(self.source.key(row) for row in rows)
+        self.at_end = len(rows) < self.page_size
+
+    def _fetch_prev(self):
+        rows = self.source.rows(self.keys[0], 'before', self.page_size)
+        self.rows[:0] = rows
+        self.keys[:0] = [self.source.key(row) for row in rows]
+        self.at_start = len(rows) < self.page_size
+
+    def _widget(self, i):
+        key = self.keys[i]
+        w = self.widgets.get(key)
+        if w is None:
+            w = self.row_widget(self.rows[i])
+            self.widgets[key] = w
+        return w
+
+    def row_widget(self, row):
+        name = row.name if isinstance(row, FileNode) else row[1]
+        metadata = self.files.get(name) if self.files is not None else None
+        attr = "missing" if metadata is not None and metadata.present is False else "normal"
+        if isinstance(row, FileNode):
+            text = format_file_node(row, row.name in self.source.expanded)
+        elif metadata is None:
+            text = format_bookmark_line(row)
+        else:
+            text = format_bookmark_line(row, metadata.present, metadata.duration)
+        if isinstance(self.source, FileTreeSource) and not isinstance(row, FileNode):
+            text = '    ' + text
+        return urwid.AttrMap(urwid.SelectableIcon(text, 0), attr, "selected")
+
+    def get_focus(self):
+        if self.focus is None:
+            return None, None
+        i = self._index(self.focus)
+        if i is None:
+            self._load_around(self.focus)
+            i = self._index(self.focus)
+            if i is None:
+                return None, None
+        return self._widget(i), self.focus
+
+    def set_focus(self, position):
+        if self._index(position) is None:
+            self._load_around(position)
+        else:
+            self.focus = position
+        self._modified()
+
+    def get_next(self, position):
+        i = self._index(position)
+        if i is None:
+            return None, None
+        if i + 1 >= len(self.rows):
+            if self.at_end:
+                return None, None
+            self._fetch_next()
+            if i + 1 >= len(self.rows):
+                return None, None
+        focus_i = self._index(self.focus) if self.focus is not None else i
+        self._trim(min(i, focus_i if focus_i is not None else i), max(i + 1, focus_i or 0))
+        i = self._index(position)
+        return self._widget(i + 1), self.keys[i + 1]
+
+    def get_prev(self, position):
+        i = self._index(position)
+        if i is None:
+            return None, None
+        if i == 0:
+            if self.at_start:
+                return None, None
+            self._fetch_prev()
+            i = self._index(position)
+            if i == 0:
+                return None, None
+        focus_i = self._index(self.focus) if self.focus is not None else i
+        self._trim(min(i - 1, focus_i if focus_i is not None else i), max(i, focus_i or 0))
+        i = self._index(position)
+        return self._widget(i - 1), self.keys[i - 1]
+
+    def apply_change(self, change, row, old_row=None):
+        """Patch the view for a bookmark added, updated or deleted.
+
+        Only the affected row changes, the source's filter and the focus
+        are kept. Rows outside the loaded window are left to be fetched
+        when scrolled to.
+        """
+        if change == 'add':
+            key = self.source.accept(row)
+            if key is not None:
+                self._insert(key, row)
+        elif change == 'delete':
+            key = self.source.find(row)
+            self.source.discard(row)
+            if key is not None:
+                self._remove(key)
+        elif change == 'update':
+            old_key = self.source.find(old_row)
+            key = self.source.accept(row)
+            i = self._index(key) if key is not None and key == old_key else None
+            if i is not None:
+                self.rows[i] = row
+                self.widgets.pop(key, None)
+            else:
+                if old_key is not None:
+                    self._remove(old_key)
+                if key is not None:
+                    self._insert(key, row)
+        self._modified()
+
+    def refresh_files(self, names):
+        """Rebuild the widgets of the loaded rows of files in names."""
+        names = set(names)
+        for key, row in zip(self.keys, self.rows):
+            if row[1] in names:
+                self.widgets.pop(key, None)
+        self._modified()
+
+    def _insert(self, key, row):
+        i = bisect.bisect_left(self.keys, key)
+        if (i == 0 and not self.at_start) or (i == len(self.keys) and not self.at_end):
+            return
+        self.keys.insert(i, key)
+        self.rows.insert(i, row)
+        if self.focus is None:
+            self.focus = key
+
+    def _remove(self, key):
+        i = self._index(key)
+        if i is None:
+            return
+        del self.keys[i]
+        del self.rows[i]
+        self.widgets.pop(key, None)
+        if self.focus == key:
+            if i < len(self.keys):
+                self.focus = self.keys[i]
+            elif i > 0:
+                self.focus = self.keys[i - 1]
+            else:
+                # the window is empty, look for rows around the old one
+                self._load_around(key)
+
+    def positions(self, reverse=False):
+        """Keys of all rows, fetched lazily page by page (for home/end)."""
+        direction = 'before' if reverse else 'after'
+        key = None
+        while True:
+            rows = self.source.rows(key, direction, self.page_size)
+            if reverse:
+                rows = rows[::-1]
+            for row in rows:
+                yield self.source.key(row)
+            if len(rows) < self.page_size:
+                return
+            key = self.source.key(rows[-1])
+
+    def get_bookmark(self, position):
+        i = self._index(position)
+        if i is None or isinstance(self.rows[i], FileNode):
+            return None
+        return bookmark_from_row(self.rows[i])
+
+    def focused_bookmark(self):
+        if self.focus is None:
+            return None
+        return self.get_bookmark(self.focus)
+
+    def focused_row(self):
+        i = self._index(self.focus) if self.focus is not None else None
+        return None if i is None else self.rows[i]
+
+class HistoryListWalker(BookmarkListWalker):
+    """List walker over a HistorySource, the most recently played first."""
+
+    def row_widget(self, entry):
+        metadata = self.files.get(entry.name) if self.files is not None else None
+        missing = metadata is not None and metadata.present is False
+        return urwid.AttrMap(urwid.SelectableIcon(format_history_line(entry), 0),
+                "missing" if missing else "normal", "selected")
+
+    def get_bookmark(self, position):
+        """The entry as a bookmark at the position it was left."""
+        i = self._index(position)
+        if i is None:
+            return None
+        entry = self.rows[i]
+        return { 'id': None, 'filename': entry.name, 'position': entry.position, 'rating': None, 'comment': '' }
+
+class BookmarkManager:
+    def __init__(self, database_path=None):
+        self.bookmarks_unfiltered = []
+        self.bookmarks_filtered = []
+        self.db = BookmarkDatabase(database_path)
+        self.moc = MocSocketController()
+        self.player = PlayingController(self.db, self.moc)
+        self.loop = None
+        self.dialog_futures = []
+        self.tasks = set()
+        # mocp is driven from a single worker thread, so commands are run in
+        # order and a slow or hung player never blocks the UI
+        self.player_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='mocp')
+        # recordings are analysed in a process of its own, created when
+        # first needed
+        self.analysis_executor = None
+        self.peak_cache = PeakCache()
+        # file name -> PeakSummary, None while it is loaded or computed or if
+        # it can't be
+        self.peak_summaries = {}
+        # the status the overview last showed, to redraw it with a loaded summary
+        self.overview_status = None
+        self.files = FileMetadataStore(self.db)
+        # files are checked file_check_batch at a time; after each batch
+        # the checker pauses file_check_throttle times as long as the
+        # batch took, at least file_check_pause seconds
+        self.file_check_batch = 50
+        self.file_check_pause = 0.5
+        self.file_check_throttle = 4
+        self.file_check_slow = 1.0
+        # the file last seen playing, to record when files are played
+        self.playing_file = None
+        # status polls while playing, while following playback and while
+        # paused or stopped; while mocp isn't running it isn't polled, only
+        # its socket is checked for a server started elsewhere
+        self.status_poll_interval = 1.0
+        self.follow_poll_interval = 0.5
+        self.idle_poll_interval = 3.0
+        self.server_check_interval = 5.0
+        # set by player commands to poll at once, created by run() on its loop
+        self.poll_wakeup = None
+        # whether the list follows the playing position, and the bookmark
+        # it last moved to
+        self.follow = False
+        self.followed_id = None
+        # seconds between writes of the playback history
+        self.history_flush_interval = 30.0
+        self.db_check_interval = 2.0
+        self.filter_string = None
+        # 'list' of bookmarks, or 'tree' of files with their bookmarks
+        self.view_mode = 'list'
+        # names of the files whose bookmarks the tree view shows
+        self.expanded_files = set()
+        self.search_handle = None
+        self.search_delay = 0.15
+        self.search_error = False
+
+    def update_view(self, w=None, size=None, key=None, filter_string=None):
+        if filter_string is None:
+            filter_string = self.filter_string
+
+        try:
+            if self.view_mode == 'tree':
+                source = FileTreeSource(self.db, filter_string, self.expanded_files)
+            else:
+                source = bookmark_source(self.db, filter_string)
+        except ValueError as e:
+            # keep showing the last valid search while a query is typed
+            self.text_timings.set_text("Invalid search: %s" % e)
+            self.search_error = True
+            return
+        if self.search_error:
+            self.text_timings.set_text('')
+            self.search_error = False
+
+        # stay on the focused bookmark, or the one that took its place,
+        # as long as the ordering stays the same
+        focus_key = None
+        if type(source) is type(self.walker.source) and \
+                getattr(source, 'order_columns', None) == getattr(self.walker.source, 'order_columns', None):
+            focus_key = self.walker.focus
+        self.walker.set_source(source, focus_key)
+
+
+    def bookmark_changed(self, change, row, old_row):
+        if change == 'reload':
+            self.files.load()
+            self.update_view()
+        elif self.view_mode == 'tree':
+            # the file's aggregates change too
+            self.update_view()
+        else:
+            self.walker.apply_change(change, row, old_row)
+        self.redraw()
+
+    async def watch_database(self):
+        """Pick up bookmarks changed by other instances."""
+        while True:
+            await asyncio.sleep(self.db_check_interval)
+            self.db.check_for_changes()
+
+    async def watch_files(self):
+        """Check whether the bookmarked files exist, and their durations,
+        in batches on a thread, slowing down when the filesystem is."""
+        while True:
+            due = self.files.due(self.file_check_batch)
+            if not due:
+                await asyncio.sleep(self.files.recheck_missing_seconds / 4)
+                continue
+            started = time.monotonic()
+            results = await self.run_in_thread(check_files, due, self.file_check_slow)
+            elapsed = time.monotonic() - started
+            changed = self.files.store(results)
+            if changed:
+                self.walker.refresh_files(changed)
+                self.redraw()
+            await asyncio.sleep(max(self.file_check_pause, elapsed * self.file_check_throttle))
+
+    def run_in_thread(self, func, *args):
+        """Run func on a new daemon thread, returns a future.
+
+        Unlike the threads of an executor, one stuck in a stat on an
+        unreachable mount doesn't keep the program from exiting.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def report(method, value):
+            if not future.done():
+                method(value)
+        def run():
+            try:
+                result = (future.set_result, func(*args))
+            except Exception as e:
+                result = (future.set_exception, e)
+            try:
+                loop.call_soon_threadsafe(report, *result)
+            except RuntimeError:
+                # the loop is closed, the program is ending
+                pass
+        threading.Thread(target=run, name=getattr(func, '__name__', None), daemon=True).start()
+        return future
+
+    def create_button(self, text, handler=None):
+        button = urwid.Button(text)
+        if handler is not None:
+            urwid.connect_signal(button, 'click', lambda button: handler(button, None, None))
+        return urwid.AttrWrap(button, "button", "button_selected")
+
+    def init_ui(self):
+    
+        # Set up color scheme
+        palette = [
+            ('titlebar', 'light green', ''),
+            ('hotkey', 'dark green,bold', ''),
+            ('quit button', 'dark red', ''),
+            ('headers', 'white,bold', ''),
+            ('normal', 'white', ''),
+            ('button', 'white', 'light blue'),
+            ('button_selected', 'black', 'yellow'),
+            ('selected', 'black', 'light green'),
+            ('missing', 'dark gray', ''),
+            ('overview', 'dark cyan', ''),
+            ('overview bookmark', 'black', 'yellow'),
+            ('overview position', 'black', 'light green')]
+    
+        header_text = urwid.Text(u'MOCP Audio File Position Tagger')
+        header = urwid.AttrMap(header_text, 'titlebar')
+        self.walker = BookmarkListWalker(KeysetBookmarkSource(self.db), self.files)
+        self.history_walker = HistoryListWalker(HistorySource(self.db), self.files)
+        self.bookmarks_listbox = urwid.ListBox(self.walker)
+        self.db.listen(self.bookmark_changed)
+    
+        # footer menu
+        menu = urwid.Text([
+            u'(', ('hotkey', u'R'), u')eload bookmarks  ',
+            u'(', ('hotkey', u'N'), u')ew  ',
+            u'(', ('hotkey', u'E'), u')dit  ',
+            u'(', ('hotkey', u'D'), u')elete selected  ',
+            u'(', ('hotkey', u'C'), u')ue sheets  ',
+            u'(', ('hotkey', u'A'), u')nalyse  ',
+            u'(', ('hotkey', u'L'), u')atency  ',
+            u'(', ('hotkey', u'H'), u')istory  ',
+            u'(', ('hotkey', u'M'), u')ode  ',
+            u'(', ('hotkey', u'F'), u')ollow  ',
+            u'(', ('quit button', u'Q'), u')uit'
+        ])
+    
+        self.bookmarks_linebox = urwid.LineBox(self.bookmarks_listbox, title="Bookmarks")
+        self.text_latency_stats = urwid.Text('', wrap='clip')
+        self.history_linebox = urwid.LineBox(urwid.ListBox(self.history_walker), title="History")
+        self.latency_stats_linebox = urwid.LineBox(
+                urwid.Filler(self.text_latency_stats, valign='top'), title="Latency")
+        #self.bookmarks_frame = urwid.Frame(header=self.make_hotkey_markup("_Bookmarks"), body=self.bookmarks_linebox)
+        self.edit_search = urwid.Edit(self.make_hotkey_markup("_Search: "))
+        urwid.connect_signal(self.edit_search, 'postchange', self.search_changed)
+        self.text_player_state = urwid.Text(["Player state: ", "unknown"])
+        self.overview = WaveformOverview()
+        self.text_timings = urwid.Text('')
+        self.text_volume = urwid.Text('')
+        self.header = urwid.Pile([
+            header,
+            urwid.Columns([self.text_player_state, ('weight', 2, self.overview)], dividechars=1),
+            self.text_timings,
+            self.edit_search,
+            urwid.GridFlow([
+                urwid.Text('Volume'),
+                self.text_volume,
+                urwid.Text('Rewind'),
+                self.create_button('2m'),
+                self.create_button("30s"),
+                self.create_button("5s"),
+                urwid.Text('Skip'),
+                self.create_button("5s"),
+                self.create_button("30s"),
+                self.create_button("2m")
+            ], 10, 1, 1, 'left'),
+            urwid.GridFlow([
+                urwid.Text('Jump to file'),
+                self.create_button("Prev", self.play_previous_file),
+                self.create_button("Next", self.play_next_file),
+                urwid.Text('Jump to bookm'),
+                self.create_button("Prev"),
+                self.create_button("Next"),
+                self.create_button("Random", self.play_random_bookmark)
+            ], 14, 1, 1, 'left')
+        ])
+    
+        # Assemble the widgets
+        self.layout = urwid.Frame(header=self.header, body=self.bookmarks_linebox, footer=menu)
+
+        self.top = SignalWrap(self.layout)
+        self.top.listen('q', self.quit)
+        self.top.listen('b', self.bookmark_playing_position)
+        self.top.listen(' ', self.toggle_pause)
+        self.top.listen('enter', self.play_selected_bookmark)
+        self.top.listen('m', self.toggle_view_mode)
+        self.top.listen('s', self.focus_search_edit)
+        self.top.listen('p', self.play_previous_bookmark)
+        self.top.listen('n', self.play_next_bookmark)
+        self.top.listen('z', self.play_random_bookmark)
+        self.top.listen('P', self.play_previous_file)
+        self.top.listen('N', self.play_next_file)
+        self.top.listen('o', self.cycle_file_order)
+        self.top.listen(',', self.rewind_30_secs)
+        self.top.listen('.', self.skip_30_secs)
+        self.top.listen('<', self.rewind_120_secs)
+        self.top.listen('>', self.skip_120_secs)
+        self.top.listen('f8', self.focus_bookmarks_list)
+        self.top.listen('tab', self.focus_bookmarks_list)
+        self.top.listen('c', self.export_cue_files)
+        self.top.listen('a', self.suggest_bookmarks)
+        self.top.listen('l', self.toggle_latency_stats)
+        self.top.listen('h', self.toggle_history)
+        self.top.listen('f', self.toggle_follow)
+        self.top.listen('e', self.edit_bookmark)
+        self.top.listen('d', self.delete_bookmark)
+        self.top.listen('r', self.update_view)
+        self.top.listen('left', self.rewind_30_secs)
+        self.top.listen('right', self.skip_30_secs)
+
+        self.palette = palette
+        self.screen = urwid.raw_display.Screen()
+        self.screen.register_palette(palette)
+        self.update_view()
+
+    def toggle_latency_stats(self, w, size, key):
+        if self.layout.body is self.bookmarks_linebox:
+            self.layout.body = urwid.Columns([self.bookmarks_linebox, self.latency_stats_linebox])
+            self.show_latency_stats()
+        else:
+            self.layout.body = self.bookmarks_linebox
+
+    def toggle_history(self, w, size, key):
+        if self.layout.body is self.history_linebox:
+            self.layout.body = self.bookmarks_linebox
+        else:
+            self.player.history.flush()
+            self.history_walker.set_source(HistorySource(self.db))
+            self.layout.body = self.history_linebox
+
+    async def flush_history(self):
+        """Write the playback history every history_flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.history_flush_interval)
+            self.player.history.flush()
+            if self.layout.body is self.history_linebox:
+                self.history_walker.set_source(HistorySource(self.db), self.history_walker.focus)
+                self.redraw()
+
+    def show_latency_stats(self):
+        self.text_latency_stats.set_text('\n'.join(latency_stats.format()))
+
+    def export_cue_files(self, w, size, key):
+        self.spawn(self.export_cue_files_task())
+
+    async def export_cue_files_task(self):
+        lb = urwid.ListBox(urwid.SimpleListWalker([
+            urwid.Text("Export all bookmarks to cue sheets?"),
+            urwid.Text(""),
+            urwid.Text("A cue sheet will be created for every file with bookmarks."),
+            urwid.Text("Sheets of files whose bookmarks didn't change are kept.")
+            ]))
+
+        if not await self.dialog(lb,
+                [ ("OK", True), ("Cancel", False), ],
+                title="Export Bookarks to CUE sheets?"):
+            return
+        result = await asyncio.get_running_loop().run_in_executor(None,
+                export_cue_sheets, self.db.path)
+        message = "%d cue sheets written, %d removed" % (result.written, result.removed)
+        if result.failed:
+            message += ", %d failed: %s" % (len(result.failed), result.failed[0][1])
+        self.text_timings.set_text(message)
+        self.redraw()
+
+    def suggest_bookmarks(self, w, size, key):
+        self.spawn(self.suggest_bookmarks_task())
+
+    async def suggest_bookmarks_task(self):
+        """Analyse the playing file, or the focused bookmark's, and offer
+        the likely track changes found as bookmarks."""
+        status = await self.run_player(self.moc.get_status)
+        if status.has_file:
+            filename = status.file
+        else:
+            b = self.walker.focused_bookmark()
+            if b is None:
+                return
+            filename = b['filename']
+        try:
+            from mocp_bookmarks_analysis import analyze_file, suggestion_bookmarks
+        except ImportError:
+            self.text_timings.set_text("Analysing recordings needs numpy")
+            return
+        self.text_timings.set_text("Analysing %s ..." % os.path.basename(filename))
+        self.redraw()
+        try:
+            suggestions = await asyncio.get_running_loop().run_in_executor(
+                    self.get_analysis_executor(), analyze_file, filename)
+        except (OSError, ValueError) as e:
+            self.text_timings.set_text("Analysis failed: %s" % e)
+            self.redraw()
+            return
+        self.text_timings.set_text("%d likely track changes found" % len(suggestions))
+        self.redraw()
+        if not suggestions:
+            return
+
+        checkboxes = [urwid.CheckBox("%s  %s" % (format_seconds(s.position), s.kind), True)
+                for s in suggestions]
+        lb = urwid.ListBox(urwid.SimpleListWalker([
+            urwid.Text(os.path.basename(filename)),
+            urwid.Text(""),
+            ] + checkboxes))
+        if not await self.dialog(lb,
+                [ ("Add", True), ("Cancel", False), ],
+                title="Suggested bookmarks"):
+            return
+        accepted = [s for s, checkbox in zip(suggestions, checkboxes) if checkbox.get_state()]
+        result = self.db.import_bookmarks(suggestion_bookmarks(filename, accepted))
+        self.text_timings.set_text("%d suggested bookmarks added" % result.added)
+        self.redraw()
+
+    def toggle_follow(self, w, size, key):
+        self.follow = not self.follow
+        self.followed_id = None
+        self.text_timings.set_text("Following playback" if self.follow else "Not following playback")
+        self.wake_poll()
+
+    def focus_closest_bookmark_to_playing_pos(self, status):
+        """Focus the bookmark nearest to the playing position.
+
+        The nearest bookmark comes from the in-memory position index and
+        the focus only moves when it changes, so following costs no query
+        while the position stays between two bookmarks.
+        """
+        row = self.player.positions.nearest(status.file, status.current_sec)
+        if row is None or row[0] == self.followed_id:
+            return
+        self.followed_id = row[0]
+        if isinstance(self.walker.source, FileTreeSource) and row[1] not in self.expanded_files:
+            key = (row[1],)
+        else:
+            key = self.walker.source.find(row)
+        if key is not None and key != self.walker.focus:
+            self.walker.set_focus(key)
+
+
+    def focused_walker(self):
+        """The walker of the list shown, the history or the bookmarks."""
+        return self.history_walker if self.layout.body is self.history_linebox else self.walker
+
+    def delete_bookmark(self, w, size, key):
+        b = self.focused_walker().focused_bookmark()
+        # history entries aren't bookmarks
+        if b is None or b['id'] is None:
+            return
+
+        # the view refocuses on the following bookmark, or the previous
+        # one if the last was deleted
+        self.db.delete(b['id'])
+
+    def focus_search_edit(self, w, size, key):
+        self.layout.set_focus('header')
+
+    def focus_bookmarks_list(self, w, size, key):
+        if self.search_handle is not None:
+            self.apply_search()
+        self.layout.set_focus('body')
+
+    def search_changed(self, edit, old_text):
+        """Search as you type, once typing pauses for search_delay seconds."""
+        if self.search_handle is not None:
+            self.search_handle.cancel()
+        self.search_handle = asyncio.get_running_loop().call_later(
+                self.search_delay, self.apply_search)
+
+    def apply_search(self):
+        if self.search_handle is not None:
+            self.search_handle.cancel()
+            self.search_handle = None
+        self.filter_string = self.edit_search.get_edit_text()
+        self.update_view()
+        self.redraw()
+
+    def toggle_view_mode(self, w, size, key):
+        """Switch between the list of bookmarks and the tree of files,
+        staying on the focused bookmark's file."""
+        row = self.walker.focused_row()
+        self.view_mode = 'list' if self.view_mode == 'tree' else 'tree'
+        self.update_view()
+        if row is not None:
+            name = row.name if isinstance(row, FileNode) else row[1]
+            if self.view_mode == 'tree':
+                self.walker.set_source(self.walker.source, (name,))
+            elif isinstance(self.walker.source, KeysetBookmarkSource):
+                first = self.db.get_bookmarks_by_file(name)
+                if first:
+                    self.walker.set_source(self.walker.source, self.walker.source.key(first[0]))
+        self.bookmarks_linebox.set_title("Files" if self.view_mode == 'tree' else "Bookmarks")
+
+    def toggle_file_node(self, node):
+        if node.name in self.expanded_files:
+            self.expanded_files.discard(node.name)
+        else:
+            self.expanded_files.add(node.name)
+        self.walker.set_source(self.walker.source, (node.name,))
+
+    def show_player_state(self, status):
+        state = ["Player state: ", status.describe()]
+        if status.has_file:
+            next_row = self.player.positions.next(status.file, status.current_sec)
+            if next_row is not None:
+                seconds = next_row[3] - status.current_sec
+                state.append(", next bookmark in %d:%02d" % (seconds // 60, seconds % 60))
+            if self.follow:
+                self.focus_closest_bookmark_to_playing_pos(status)
+        self.text_player_state.set_text(state)
+        self.text_volume.set_text(status.volume_bar())
+        self.player.history.observe(status)
+        if status.has_file and status.file != self.playing_file:
+            self.playing_file = status.file
+            self.player.files.mark_played(status.file)
+        if status.has_file and status.total_sec > 0 and \
+                self.files.set_duration(status.file, status.total_sec):
+            self.walker.refresh_files([status.file])
+        self.show_overview(status)
+        self.redraw()
+
+    def show_overview(self, status):
+        self.overview_status = status
+        if not status.has_file:
+            self.overview.set(None, 0, [], None)
+            return
+        summary = self.peak_summary(status.file)
+        duration = status.total_sec
+        if duration <= 0 and summary is not None:
+            duration = summary.duration
+        self.overview.set(summary, duration,
+                self.player.positions.get_positions(status.file), status.current_sec)
+
+    def peak_summary(self, filename):
+        """Return the PeakSummary of filename, None until it is loaded.
+
+        The first call starts loading it in the background, and computing
+        it if it isn't cached: finding the cache file stats the
+        recording, which can hang on an unreachable mount.
+        """
+        if filename not in self.peak_summaries:
+            self.peak_summaries[filename] = None
+            self.spawn(self.load_peaks_task(filename))
+        return self.peak_summaries[filename]
+
+    async def load_peaks_task(self, filename):
+        summary = await self.run_in_thread(self.peak_cache.get, filename)
+        if summary is None:
+            summary = await self.cache_peaks(filename)
+        if summary is None:
+            return
+        self.peak_summaries[filename] = summary
+        if self.overview_status is not None and self.overview_status.file == filename:
+            self.show_overview(self.overview_status)
+        self.redraw()
+
+    async def cache_peaks(self, filename):
+        try:
+            from mocp_bookmarks_analysis import cache_peaks
+        except ImportError:
+            return None
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.get_analysis_executor(),
+                    cache_peaks, filename, self.peak_cache.directory)
+        except (OSError, ValueError):
+            # e.g. no decoder for the format, the overview shows bookmarks only
+            return None
+        return await self.run_in_thread(self.peak_cache.get, filename)
+
+    def get_analysis_executor(self):
+        if self.analysis_executor is None:
+            # spawned, since forking a process with running threads is unsafe
+            self.analysis_executor = concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                    mp_context=multiprocessing.get_context('spawn'))
+        return self.analysis_executor
+
+    async def update_player_state(self):
+        status = await self.run_player(self.moc.get_status)
+        self.show_player_state(status)
+        return status
+
+    def poll_interval(self, status):
+        """Seconds until the next status poll: short while playing, longer
+        while paused or stopped, None while mocp isn't running."""
+        if status.state == 'PLAY':
+            return self.follow_poll_interval if self.follow else self.status_poll_interval
+        if status.is_running:
+            return self.idle_poll_interval
+        return None
+
+    def wake_poll(self):
+        if self.poll_wakeup is not None:
+            self.poll_wakeup.set()
+
+    def server_socket_state(self):
+        try:
+            st = os.stat(self.moc.socket_path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    async def wait_for_server(self):
+        """Wait for a player command, or for mocp to create its socket.
+
+        Querying a player that isn't running costs a mocp process, so it
+        isn't polled; a stat of the socket notices a server started
+        outside this program. A socket left behind by a crashed server
+        doesn't count, only one that changes.
+        """
+        socket_state = self.server_socket_state()
+        while True:
+            try:
+                await asyncio.wait_for(self.poll_wakeup.wait(), self.server_check_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if self.server_socket_state() != socket_state:
+                return
+
+    async def poll_player_state(self):
+        while True:
+            self.poll_wakeup.clear()
+            status = await self.update_player_state()
+            if self.layout.body is not self.bookmarks_linebox and \
+                    self.layout.body is not self.history_linebox:
+                self.show_latency_stats()
+            # player commands wake the poll up early
+            interval = self.poll_interval(status)
+            if interval is None:
+                await self.wait_for_server()
+                continue
+            try:
+                await asyncio.wait_for(self.poll_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def run_player(self, func, *args):
+        """Run a MocController call on the player thread, returns a future."""
+        return asyncio.get_running_loop().run_in_executor(self.player_executor,
+                functools.partial(func, *args))
+
+    async def player_command(self, func, *args):
+        await self.run_player(func, *args)
+        await self.update_player_state()
+        self.wake_poll()
+
+    def spawn(self, coro):
+        """Run coro as a background task of the UI loop."""
+        task = asyncio.get_running_loop().create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.text_player_state.set_text(["Error: ", repr(task.exception())])
+            self.redraw()
+
+    def redraw(self):
+        if self.loop is not None:
+            self.loop.draw_screen()
+
+    def quit(self, w, size, key):
+        raise urwid.ExitMainLoop()
+
+    def toggle_pause(self, w, size, key):
+        self.spawn(self.player_command(self.moc.toggle_pause))
+
+    async def play_bookmark_task(self, b):
+        timings = await self.run_player(self.player.play_bookmark, b)
+        self.text_timings.set_text(format_timings(timings))
+        await self.update_player_state()
+        self.wake_poll()
+
+    def play_selected_bookmark(self, w, size, key):
+        walker = self.focused_walker()
+        row = walker.focused_row()
+        if isinstance(row, FileNode):
+            self.toggle_file_node(row)
+            return
+        b = walker.focused_bookmark()
+        if b is None:
+            return
+        self.spawn(self.play_bookmark_task(b))
+
+    async def play_relative_bookmark(self, get_bookmark):
+        status = await self.run_player(self.moc.get_status)
+        row = get_bookmark(status)
+        if not row is None:
+            await self.play_bookmark_task(bookmark_from_row(row))
+
+    def play_previous_bookmark(self, w, size, key):
+        self.spawn(self.play_relative_bookmark(self.player.previous_bookmark))
+
+    def play_next_bookmark(self, w, size, key):
+        self.spawn(self.play_relative_bookmark(self.player.next_bookmark))
+
+    def play_previous_file(self, w, size, key):
+        self.spawn(self.play_relative_bookmark(self.player.previous_file_bookmark))
+
+    def play_next_file(self, w, size, key):
+        self.spawn(self.play_relative_bookmark(self.player.next_file_bookmark))
+
+    def cycle_file_order(self, w, size, key):
+        orders = self.player.files.orders
+        self.player.file_order = orders[(orders.index(self.player.file_order) + 1) % len(orders)]
+        self.text_timings.set_text("Jumping to files in %s order" % self.player.file_order)
+
+    def play_random_bookmark(self, w, size, key):
+        """Play a random bookmark, weighted by rating, of those the search shows."""
+        try:
+            row = self.player.random_bookmark(search_string=self.filter_string)
+        except ValueError as e:
+            self.text_timings.set_text("Invalid search: %s" % e)
+            return
+        if row is not None:
+            self.spawn(self.play_bookmark_task(bookmark_from_row(row)))
+
+    def rewind_30_secs(self, w, size, key):
+        self.spawn(self.player_command(self.moc.rewind, 30))
+
+    def skip_30_secs(self, w, size, key):
+        self.spawn(self.player_command(self.moc.skip, 30))
+
+    def rewind_120_secs(self, w, size, key):
+        self.spawn(self.player_command(self.moc.rewind, 120))
+
+    def skip_120_secs(self, w, size, key):
+        self.spawn(self.player_command(self.moc.skip, 120))
+
+    def write_selection_to_file(self):
+        #self.directory = self.bookmarks[self.listbox.focus_position]['dir']
+        pass
+
+    def bookmark_playing_position(self, w, size, key):
+        self.spawn(self.bookmark_playing_position_task())
+
+    async def bookmark_playing_position_task(self):
+        status = await self.update_player_state()
+        if not status.has_file:
+            # TODO: notify user
+            return
+
+        b = await self.new_bookmark_dialog(status.file, status.current_sec)
+        if b == None:
+            return
+        rating = b['rating']
+        if rating != None:
+            rating = min(MAX_RATING, rating)
+        comment = b['comment']
+        if comment == None:
+            comment = ""
+
+        self.db.add(b['filename'], b['position'], rating, comment)
+        #, bookmark['rating'], bookmark['comment'])
+
+    def run(self):
+        self.init_ui()
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+        self.poll_wakeup = asyncio.Event()
+        self.loop = urwid.MainLoop(self.top, self.palette, screen=self.screen,
+                event_loop=urwid.AsyncioEventLoop(loop=event_loop),
+                unhandled_input=self.unhandled_input)
+        # redraws, and the part of them spent writing to the terminal
+        self.loop.draw_screen = latency_stats.timed('ui')(self.loop.draw_screen)
+        self.screen.draw_screen = latency_stats.timed('ui', 'terminal output')(self.screen.draw_screen)
+        event_loop.call_soon(self.spawn, self.poll_player_state())
+        event_loop.call_soon(self.spawn, self.watch_database())
+        event_loop.call_soon(self.spawn, self.watch_files())
+        event_loop.call_soon(self.spawn, self.flush_history())
+        try:
+            self.loop.run()
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.player.history.flush()
+            self.player_executor.shutdown(wait=False, cancel_futures=True)
+            if self.analysis_executor is not None:
+                self.analysis_executor.shutdown(wait=False, cancel_futures=True)
+            self.moc.disconnect()
+
+    def unhandled_input(self, key):
+        if key == 'esc':
+            if len(self.dialog_futures) > 0:
+                self.dialog_futures[-1].set_result(False)
+            else:
+                raise urwid.ExitMainLoop()
+
+    def dialog(self, content, buttons_and_results,
+            title=None, bind_enter_esc=True, focus_buttons=False,
+            extra_bindings=[]):
+        """Show a modal dialog on top of the main window.
+
+        Returns a future which resolves to the result of the chosen
+        button. The calling task awaits it, the UI loop keeps running.
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        def close(res):
+            if not future.done():
+                future.set_result(res)
+
+        class ResultSetter:
+            def __init__(subself, res):  # noqa
+                subself.res = res
+
+            def __call__(subself, *args):  # noqa
+                close(subself.res)
+
+        Attr = urwid.AttrMap  # noqa
+
+        if bind_enter_esc:
+            content = SignalWrap(content)
+
+            def enter(w, size, key):
+                close(True)
+
+            def esc(w, size, key):
+                close(False)
+
+            content.listen("enter", enter)
+            content.listen("esc", esc)
+
+        button_widgets = []
+        for btn_descr in buttons_and_results:
+            if btn_descr is None:
+                button_widgets.append(urwid.Text(""))
+            else:
+                btn_text, btn_result = btn_descr
+                button_widgets.append(
+                        Attr(urwid.Button(btn_text, ResultSetter(btn_result)),
+                            "button", "focused button"))
+
+        w = urwid.Columns([
+            content,
+            ("fixed", 15, urwid.ListBox(urwid.SimpleListWalker(button_widgets))),
+            ], dividechars=1)
+
+        if focus_buttons:
+            w.set_focus_column(1)
+
+        if title is not None:
+            w = urwid.Pile([
+                ("flow", urwid.AttrMap(
+                    urwid.Text(title, align="center"),
+                    "dialog title")),
+                ("fixed", 1, urwid.SolidFill()),
+                w])
+
+        w = SignalWrap(w)
+        for key, binding in extra_bindings:
+            if isinstance(binding, str):
+                w.listen(key, ResultSetter(binding))
+            else:
+                w.listen(key, binding)
+
+        w = urwid.LineBox(w)
+
+        w = urwid.Overlay(w, self.top,
+                align="center",
+                valign="middle",
+                width=("relative", 75),
+                height=("relative", 75),
+                )
+        w = Attr(w, "background")
+
+        previous_widget = self.loop.widget
+        self.loop.widget = w
+        self.dialog_futures.append(future)
+
+        def restore(future):
+            self.dialog_futures.remove(future)
+            self.loop.widget = previous_widget
+
+        future.add_done_callback(restore)
+        return future
+
+    def edit_bookmark(self, w, size, key):
+        b = self.focused_walker().focused_bookmark()
+        if b is None or b['id'] is None:
+            return
+        self.spawn(self.edit_bookmark_task(b))
+
+    async def edit_bookmark_task(self, b):
+        b = await self.edit_bookmark_dialog(b)
+        if b == None:
+            return
+
+        rating = b['rating']
+        if rating != None:
+            rating = min(MAX_RATING, rating)
+        comment = b['comment']
+        if comment == None:
+            comment = ""
+        self.db.update(b['id'], rating, comment)
+
+
+    async def edit_bookmark_dialog(ui, b):
+        edit_rating = urwid.IntEdit("Rating: ", b['rating'])
+        edit_comment = urwid.Edit("Comment: ", b['comment'])
+
+        lb_contents = ([edit_rating, edit_comment])
+        lb = urwid.ListBox(urwid.SimpleListWalker(lb_contents))
+
+        if await ui.dialog(lb,         [
+                    ("OK", True),
+                    ("Cancel", False),
+                ],
+                title="Edit bookmark"):
+            return { 'id': b['id'], "filename": b['filename'], "position": b['position'], "rating": edit_rating.value(), "comment": edit_comment.get_edit_text() }
+
+
+    async def new_bookmark_dialog(ui, filename, position):
+
+        heading = urwid.Text("Save a bookmark for the current position\n")
+        edit_rating = urwid.IntEdit("Rating: ")
+        edit_comment = urwid.Edit("Comment: ")
+
+        lb_contents = ([heading, edit_rating, edit_comment])
+        lb = urwid.ListBox(urwid.SimpleListWalker(lb_contents))
+
+        if await ui.dialog(lb,         [
+                    ("OK", True),
+                    ("Cancel", False),
+                ],
+                title="Bookmark position"):
+            return { "filename": filename, "position": position, "rating": edit_rating.value(), "comment": edit_comment.get_edit_text() }
+
+    def make_hotkey_markup(self, s):
+        import re
+        match = re.match(r"^([^_]*)_(.)(.*)$", s)
+        assert match is not None
+    
+        return [
+                (None, match.group(1)),
+                ("hotkey", match.group(2)),
+                (None, match.group(3)),
+                ]
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#encoding=utf-8
+"""Check that MocSocketController and the fake MOC server understand
+each other.
+
+    ./tools/check_fake_moc_server.py
+
+First compares the client's MOC_* protocol constants with those of the
+fake server, which are copied from moc's protocol.h on their own. Then
+starts tools/fake_moc_server.py on a temporary socket, queries the
+status, plays a file at a position and seeks through the controller,
+checking the status the server reports after every step. The mocp
+command fallback is pointed at a missing binary, so a step that doesn't
+go over the socket fails instead of passing through a real mocp. Exits
+with 1 if a check fails.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+
+import mocp_bookmarks
+import fake_moc_server
+from mocp_bookmarks import MocSocketController
+from fake_moc_server import FakeMocServer
+
+FILENAME = '/music/mix-0001.mp3'
+
+def protocol_checks():
+    """(name, client value, protocol.h value) of the client's constants."""
+    checks = []
+    for name in sorted(dir(mocp_bookmarks)):
+        if name.startswith('MOC_CMD_') or name.startswith('MOC_EV_'):
+            checks.append((name, getattr(mocp_bookmarks, name),
+                    getattr(fake_moc_server, name[len('MOC_'):], None)))
+    for value, state in sorted(mocp_bookmarks.MOC_STATES.items()):
+        checks.append(('MOC_STATES[%s]' % state, value,
+                getattr(fake_moc_server, 'STATE_' + state, None)))
+    events = { value: name for name, value in vars(fake_moc_server).items() if name.startswith('EV_') }
+    string_events = (fake_moc_server.EV_SRV_ERROR, fake_moc_server.EV_STATUS_MSG)
+    for value in mocp_bookmarks.MOC_STRING_EVENTS:
+        checks.append(('string event %s' % events.get(value, hex(value)), value,
+                value if value in string_events else None))
+    # EV_FILE_TAGS carries tags, the rest of the events nothing
+    for value in mocp_bookmarks.MOC_PLAIN_EVENTS:
+        checks.append(('plain event %s' % events.get(value, hex(value)), value,
+                value if value in events and value not in string_events
+                    and value != fake_moc_server.EV_FILE_TAGS else None))
+    return checks
+
+def main():
+    failed = 0
+
+    def check(what, condition, status):
+        nonlocal failed
+        failed += not condition
+        print("%s  %s: %s" % ('ok  ' if condition else 'FAIL', what, status))
+
+    for name, value, expected in protocol_checks():
+        check(name, value == expected, "0x%02x, protocol.h: %s" % (value,
+                'missing' if expected is None else '0x%02x' % expected))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        server = FakeMocServer(os.path.join(work_dir, 'socket2'), duration=3600, volume=40)
+        server.start()
+        moc = MocSocketController(server.socket_path)
+        moc.mocp_binary = os.path.join(work_dir, 'no-mocp')
+        try:
+            status = moc.get_status(max_age=0)
+            check("get_status", status.state == 'STOP' and status.file is None
+                    and status.volume == 40, status)
+
+            moc.play_at(FILENAME, 600)
+            status = moc.get_status(max_age=0)
+            check("play_at", status.state == 'PLAY' and status.file == FILENAME
+                    and abs(status.current_sec - 600) <= moc.position_tolerance
+                    and status.total_sec == 3600, status)
+
+            moc.skip(60)
+            status = moc.get_status(max_age=0)
+            check("skip", abs(status.current_sec - 660) <= moc.position_tolerance, status)
+
+            moc.rewind(120)
+            status = moc.get_status(max_age=0)
+            check("rewind", abs(status.current_sec - 540) <= moc.position_tolerance, status)
+
+            moc.jump_to_second(30)
+            status = moc.get_status(max_age=0)
+            check("jump_to_second", status.file == FILENAME
+                    and abs(status.current_sec - 30) <= moc.position_tolerance, status)
+
+            moc.toggle_pause()
+            status = moc.get_status(max_age=0)
+            check("toggle_pause", status.state == 'PAUSE', status)
+        finally:
+            moc.disconnect()
+            server.shutdown()
+            server.server_close()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#encoding=utf-8
+"""Fake MOC server speaking the subset of the socket protocol used by
+MocSocketController, for trying the socket backend without a real mocp.
+
+    ./tools/fake_moc_server.py --socket /tmp/moc-socket2 --duration 3600
+
+Then point the controller at it:
+
+    moc = MocSocketController('/tmp/moc-socket2')
+
+The fake keeps one 'playlist' with a single file whose playing position
+advances with the wall clock. Files aren't opened, any path plays.
+"""
+
+import argparse
+import os
+import select
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+# copied from moc's protocol.h, not from mocp_bookmarks.py, so that
+# check_fake_moc_server.py can compare the client's constants with them;
+# only the commands marked * are implemented
+CMD_PLAY = 0x00             # *
+CMD_LIST_CLEAR = 0x01       # *
+CMD_LIST_ADD = 0x02         # *
+CMD_STOP = 0x04             # *
+CMD_PAUSE = 0x05            # *
+CMD_UNPAUSE = 0x06          # *
+CMD_SET_OPTION = 0x07
+CMD_GET_OPTION = 0x08
+CMD_GET_CTIME = 0x0d        # *
+CMD_GET_SNAME = 0x0f        # *
+CMD_NEXT = 0x10
+CMD_QUIT = 0x11
+CMD_SEEK = 0x12             # *
+CMD_GET_STATE = 0x13        # *
+CMD_DISCONNECT = 0x15       # *
+CMD_GET_BITRATE = 0x16
+CMD_GET_RATE = 0x17
+CMD_GET_CHANNELS = 0x18
+CMD_PING = 0x19             # *
+CMD_GET_MIXER = 0x1a        # *
+CMD_SET_MIXER = 0x1b        # *
+CMD_DELETE = 0x1c
+CMD_SEND_PLIST_EVENTS = 0x1d
+CMD_PREV = 0x20
+CMD_GET_TAGS = 0x2c         # *
+CMD_TOGGLE_MIXER_CHANNEL = 0x2d
+CMD_GET_AVG_BITRATE = 0x33
+CMD_TOGGLE_SOFTMIXER = 0x34
+CMD_TOGGLE_EQUALIZER = 0x35
+CMD_EQUALIZER_REFRESH = 0x36
+CMD_EQUALIZER_PREV = 0x37
+CMD_EQUALIZER_NEXT = 0x38
+CMD_TOGGLE_MAKE_MONO = 0x39
+CMD_JUMP_TO = 0x3a          # *
+CMD_QUEUE_ADD = 0x3b
+
+EV_STATE = 0x01
+EV_CTIME = 0x02
+EV_SRV_ERROR = 0x04
+EV_BUSY = 0x05
+EV_DATA = 0x06
+EV_BITRATE = 0x07
+EV_RATE = 0x08
+EV_CHANNELS = 0x09
+EV_EXIT = 0x0a
+EV_PONG = 0x0b
+EV_OPTIONS = 0x0c
+EV_SEND_PLIST = 0x0d
+EV_TAGS = 0x0e
+EV_STATUS_MSG = 0x0f
+EV_MIXER_CHANGE = 0x10
+EV_FILE_TAGS = 0x11
+EV_AVG_BITRATE = 0x12
+EV_AUDIO_START = 0x13
+EV_AUDIO_STOP = 0x14
+
+STATE_PLAY = 0x01
+STATE_STOP = 0x02
+STATE_PAUSE = 0x03
+
+
+class Player:
+    """Player state shared by all client connections."""
+
+    def __init__(self, duration=3600, volume=70):
+        self.lock = threading.Lock()
+        self.duration = duration
+        self.volume = volume
+        self.playlist = []
+        self.file = ''
+        self.state = STATE_STOP
+        self._position = 0.0
+        self._started = 0.0
+
+    def position(self):
+        if self.state == STATE_PLAY:
+            return min(self.duration, self._position + time.monotonic() - self._started)
+        return self._position
+
+    def play(self, filename):
+        if filename == '' and self.playlist:
+            filename = self.playlist[0]
+        self.file = filename
+        self.state = STATE_PLAY
+        self._position = 0.0
+        self._started = time.monotonic()
+
+    def pause(self):
+        if self.state == STATE_PLAY:
+            self._position = self.position()
+            self.state = STATE_PAUSE
+
+    def unpause(self):
+        if self.state == STATE_PAUSE:
+            self._started = time.monotonic()
+            self.state = STATE_PLAY
+
+    def stop(self):
+        self.state = STATE_STOP
+        self.file = ''
+        self._position = 0.0
+
+    def jump(self, second):
+        if self.state == STATE_STOP:
+            return
+        self._position = float(max(0, min(self.duration, second)))
+        self._started = time.monotonic()
+
+
+class Handler(socketserver.BaseRequestHandler):
+
+    def recv_exact(self, size):
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.request.recv(size - len(buf))
+            if not chunk:
+                raise EOFError()
+            buf += chunk
+        return bytes(buf)
+
+    def recv_int(self):
+        return struct.unpack('=i', self.recv_exact(4))[0]
+
+    def recv_str(self):
+        return self.recv_exact(self.recv_int()).decode('utf-8', 'replace')
+
+    def send(self, *values):
+        packet = bytearray()
+        for value in values:
+            if isinstance(value, str):
+                data = value.encode('utf-8')
+                packet += struct.pack('=i', len(data)) + data
+            else:
+                packet += struct.pack('=i', value)
+        self.request.sendall(packet)
+
+    def pending(self):
+        """Whether more of the client's commands have already arrived."""
+        return bool(select.select([self.request], [], [], 0)[0])
+
+    def handle(self):
+        player = self.server.player
+        try:
+            while True:
+                # the latency is a round trip's: commands the client sent
+                # together, like the five of a status query, share one
+                new_round_trip = not self.pending()
+                cmd = self.recv_int()
+                if self.server.latency and new_round_trip:
+                    time.sleep(self.server.latency)
+                with player.lock:
+                    if cmd == CMD_DISCONNECT:
+                        return
+                    self.dispatch(player, cmd)
+        except (EOFError, ConnectionError):
+            return
+
+    def dispatch(self, player, cmd):
+        if cmd == CMD_GET_STATE:
+            self.send(EV_DATA, player.state)
+        elif cmd == CMD_GET_SNAME:
+            self.send(EV_DATA, player.file if player.state != STATE_STOP else '')
+        elif cmd == CMD_GET_CTIME:
+            self.send(EV_DATA, int(player.position()))
+        elif cmd == CMD_GET_TAGS:
+            total = player.duration if player.state != STATE_STOP else -1
+            self.send(EV_DATA, '', '', '', -1, total, 0)
+        elif cmd == CMD_GET_MIXER:
+            self.send(EV_DATA, player.volume)
+        elif cmd == CMD_SET_MIXER:
+            player.volume = max(0, min(100, self.recv_int()))
+        elif cmd == CMD_LIST_CLEAR:
+            player.playlist = []
+        elif cmd == CMD_LIST_ADD:
+            player.playlist.append(self.recv_str())
+        elif cmd == CMD_PLAY:
+            player.play(self.recv_str())
+            self.send(EV_STATE)
+        elif cmd == CMD_STOP:
+            player.stop()
+            self.send(EV_STATE)
+        elif cmd == CMD_PAUSE:
+            player.pause()
+            self.send(EV_STATE)
+        elif cmd == CMD_UNPAUSE:
+            player.unpause()
+            self.send(EV_STATE)
+        elif cmd == CMD_SEEK:
+            player.jump(player.position() + self.recv_int())
+        elif cmd == CMD_JUMP_TO:
+            player.jump(self.recv_int())
+        elif cmd == CMD_PING:
+            self.send(EV_PONG)
+        else:
+            raise ConnectionError("unsupported command 0x%02x" % cmd)
+
+
+class FakeMocServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, duration=3600, volume=70, latency=0.0):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        socketserver.ThreadingUnixStreamServer.__init__(self, socket_path, Handler)
+        self.socket_path = socket_path
+        self.player = Player(duration, volume)
+        self.latency = latency
+
+    def start(self):
+        """Serve from a background thread, for use inside a test process."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake MOC server for testing.")
+    parser.add_argument('--socket', default=os.path.expanduser('~/.moc/socket2'),
+            help="path of the UNIX socket to listen on")
+    parser.add_argument('--duration', type=int, default=3600,
+            help="length in seconds of every played file")
+    parser.add_argument('--volume', type=int, default=70)
+    parser.add_argument('--latency', type=float, default=0.0,
+            help="seconds every round trip of commands takes")
+    args = parser.parse_args()
+
+    server = FakeMocServer(args.socket, args.duration, args.volume, args.latency)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())